@@ -1,15 +1,20 @@
 import sys
 import os
-import matplotlib.pyplot as plt
+import random
+import numpy as np
 import time
 import argparse
+from contextlib import redirect_stdout
 import math
 from functools import partial
 from multiprocessing import Pool, freeze_support
 
 from prog.packing import Packing
-from prog.visualize import plot_packing
-from prog.fitness import fitness
+from prog.fitness import fitness, set_fitness_backend
+from prog.nfp import set_nfp_store, set_placement_policy, PLACEMENT_POLICIES
+from prog.batch import run_batch, write_summary
+from prog.output import FORMATS, save_packing, load_packing
+from prog.stats import enable_stats, write_report
 
 def input_data(lines):
     mode, *other = lines
@@ -19,15 +24,29 @@ def input_data(lines):
         return autogenerator_input(mode.strip().split()[1], other)
 
 
+def algo_parameters(algo, lines):
+    """returns the extra parameters of the algorithm `algo`, given at the beginning of `lines`, and the next lines"""
+    if algo == 'simulated annealing':
+        return [float(lines[0]), float(lines[1])], lines[2:]
+    elif algo == 'parallel tempering':
+        # initial temperature, temperature decrease rate, number of chains, exchange interval and optionally a seed
+        algo_extra = [float(lines[0]), float(lines[1]), int(lines[2]), int(lines[3])]
+        if lines[4].strip().lstrip('-').isdigit():
+            return algo_extra + [int(lines[4])], lines[5:]
+        return algo_extra + [None], lines[4:]
+    elif algo == 'genetic':
+        # population size, number of generations, mutation rate and optionally a seed
+        algo_extra = [int(lines[0]), int(lines[1]), float(lines[2])]
+        if lines[3].strip().lstrip('-').isdigit():
+            return algo_extra + [int(lines[3])], lines[4:]
+        return algo_extra + [None], lines[3:]
+    return [], lines
+
+
 def classic_input(lines):
     sort, xbin, ybin, algo, *other = lines
     bin_size = (float(xbin), float(ybin))
-    algo_extra = []
-    if algo.strip() == 'simulated annealing':
-        algo_extra.extend([float(other[0]), float(other[1])])
-        figures = other[2:]
-    else:
-        figures = other
+    algo_extra, figures = algo_parameters(algo.strip(), other)
     polygons = {}
     for line in figures:
         if line.strip() == '(':
@@ -44,12 +63,7 @@ def classic_input(lines):
 def autogenerator_input(dirname, lines):
     calculate, sort, xbin, ybin, start, stop, step, algo, *other = lines
     bin_size = (float(xbin), float(ybin))
-    algo_extra = []
-    if algo.strip() == 'simulated annealing':
-        algo_extra.extend([float(other[0]), float(other[1])])
-        figures = other[2:]
-    else:
-        figures = other
+    algo_extra, figures = algo_parameters(algo.strip(), other)
     polylist = []
     for line in figures:
         figure, *params = line.strip().split()
@@ -65,29 +79,44 @@ def autogenerator_input(dirname, lines):
     return 'autogenerator', polylist, int(start), int(stop), int(step), sort.strip(), bin_size, algo.strip(), algo_extra, dirname, calculate.strip()
     
     
-def autogenerate_files(data):
+def autogenerate_jobs(data, write_files=True):
+    """Yields lazily the job of each count of figures: (name, (polygons, bin_size, algo, algo_extra, sort)),
+    where name is the path of the corresponding classic input file, which is only written if `write_files` is True
+    """
     polylist, start, stop, step, sort, bin_size, algo, algo_extra, dirname, calculate = data
     path = 'input/classic/' + dirname
-    os.mkdir(path, mode=0o777, dir_fd=None)
-    filenames = []
     for count in range(start, stop, step):
         filename = path + '/' + str(count) + '.txt'
-        filenames.append(filename)
-        with open(filename, 'w') as f:
-            print('classic_input', file=f)
-            print(sort, file=f)
-            print(bin_size[0], file=f)
-            print(bin_size[1], file=f)
-            print(algo, file=f)
-            for i in algo_extra:
+        polygons = {polygon: count for polygon in polylist}
+        if write_files:
+            write_classic_input(filename, polygons, bin_size, algo, algo_extra, sort)
+        yield filename, (polygons, bin_size, algo, algo_extra, sort)
+
+
+def autogenerate_files(data, write_files=True):
+    """returns the lazy iterator of generated jobs (see `autogenerate_jobs`), calculation settings and the directory of the generated files"""
+    *_, dirname, calculate = data
+    path = 'input/classic/' + dirname
+    os.makedirs(path, exist_ok=True)  # the directory may exist when a stopped calculation is resumed
+    return autogenerate_jobs(data, write_files), calculate, path
+
+
+def write_classic_input(filename, polygons, bin_size, algo, algo_extra, sort):
+    with open(filename, 'w') as f:
+        print('classic_input', file=f)
+        print(sort, file=f)
+        print(bin_size[0], file=f)
+        print(bin_size[1], file=f)
+        print(algo, file=f)
+        for i in algo_extra:
+            if i is not None:
                 print(i, file=f)
-            for polygon in polylist:
-                print('(', file=f)
-                for point in polygon:
-                    print('    ' + str(point), file=f)
-                print(')', file=f)
-                print(count, file=f)
-    return filenames, calculate, path
+        for polygon, count in polygons.items():
+            print('(', file=f)
+            for point in polygon:
+                print('    ' + str(point), file=f)
+            print(')', file=f)
+            print(count, file=f)
 
 
 #def make_calculations(filenames, infofilename, path):
@@ -115,73 +144,121 @@ def autogenerate_files(data):
 #        print(fitlist, file=infofile)
         
         
-def make_calculations(filenames, infofilename, path):
-    with Pool(8) as pool:
-        try:
-            results = pool.map(calc, filenames)    
-        except Exception as e:
-            raise e
-    timelist = [res[2] for res in results]
-    fitlist = [res[3] for res in results]
-    countlist = [res[0] for res in results]
-    binsusedlist = [res[1] for res in results]
-    with open(path + '/' + infofilename + '.txt', 'w') as infofile:
-        print(countlist, file=infofile)
-        print(binsusedlist, file=infofile)
-        print(timelist, file=infofile)
-        print(fitlist, file=infofile)
+def init_worker(nfp_cache, fitness_backend, profile=False, placement_policy='bottom left'):
+    set_nfp_store(nfp_cache)
+    set_fitness_backend(fitness_backend)
+    set_placement_policy(placement_policy)
+    if profile:
+        enable_stats()
+
+
+def make_calculations(jobs, infofilename, path, nfp_cache=None, fitness_backend='shapely', workers=None, timeout=None, profile=False,
+                      placement_policy='bottom left'):
+    # `jobs` are (name, instance) pairs, see `autogenerate_jobs`, instances are sent to the workers without any file
+    # results are streamed to a JSONL file as jobs finish, so an interrupted calculation can be resumed by running it again
+    # all workers share the persistent cache of minkowski sums, if any
+    # with `profile`, each result has the stats of its job (see prog.stats)
+    records = run_batch(calc_instance, jobs, path + '/' + infofilename + '.jsonl', workers, timeout,
+                        initializer=init_worker, initargs=(nfp_cache, fitness_backend, profile, placement_policy))
+    write_summary(records, path + '/' + infofilename + '.txt')
         
         
-def calc(filename):
-    with open(filename) as f:
-        lines = f.readlines()
-        _, *data = input_data(lines)
-        polygons, bin_size, algo, algo_extra, figures_sorting_type = data
-        count = sum(list(polygons.values()))
-        packing = Packing(bin_size, polygons)
-        time1 = time.time()
-        packing.nest_all(False, algo, figures_sorting_type, algo_extra)
-        time2 = time.time() - time1
-        fit = fitness(packing.bins, packing.bin_size, packing.coeffs)
+def calc_instance(data):
+    polygons, bin_size, algo, algo_extra, figures_sorting_type = data
+    count = sum(list(polygons.values()))
+    packing = Packing(bin_size, polygons)
+    time1 = time.time()
+    packing.nest_all(False, algo, figures_sorting_type, algo_extra)
+    time2 = time.time() - time1
+    fit = fitness(packing.bins, packing.bin_size, packing.coeffs)
     return count, len(packing.bins), time2, fit
         
 
 def main():
     # main speed bottlenecks are visible in this profiling, function `get_minkowski_sum`, `pc.AddPaths` and `get_clipping_limits`
-    # IMPORTANT first run is slow as numba compiles functions, always run TWICE
+    # (counts and times of these hot paths are reported with the key --profile, see prog.stats)
+    # numba functions are compiled on first use and cached in __pycache__, run `python -m prog.warmup` once after install (see prog/warmup.py)
     
     parser = argparse.ArgumentParser()
     parser.add_argument ('-i', '--input', required=True, type=argparse.FileType())
     parser.add_argument ('-o', '--output', default='stdout')
     parser.add_argument ('-p', '--plot', action='store_const', const=True)
+    parser.add_argument ('-j', '--jobs', default=1, type=int)
+    parser.add_argument ('--nfp-cache', default=None)
+    parser.add_argument ('--fitness-backend', default='shapely', choices=['shapely', 'numba'])
+    parser.add_argument ('--chains', default=None, type=int)
+    parser.add_argument ('--exchange-interval', default=None, type=int)
+    parser.add_argument ('--seed', default=None, type=int)
+    parser.add_argument ('--time-budget', default=None, type=float)
+    parser.add_argument ('--max-iterations', default=None, type=int)
+    parser.add_argument ('-w', '--workers', default=None, type=int)
+    parser.add_argument ('--job-timeout', default=None, type=float)
+    parser.add_argument ('--no-files', action='store_const', const=True)
+    parser.add_argument ('--format', default='repr', choices=FORMATS)
+    parser.add_argument ('--resume', default=None)
+    parser.add_argument ('--profile', nargs='?', const='-', default=None)
+    parser.add_argument ('--placement', default='bottom left', choices=PLACEMENT_POLICIES)
     namespace = parser.parse_args(sys.argv[1:])
     lines = namespace.input.readlines()
+    set_nfp_store(namespace.nfp_cache)
+    set_fitness_backend(namespace.fitness_backend)
+    set_placement_policy(namespace.placement)
+    if namespace.seed is not None:
+        random.seed(namespace.seed)
+        np.random.seed(namespace.seed)
     mode, *data = input_data(lines)
     if mode == 'classic_input':
         polygons, bin_size, algo, algo_extra, figures_sorting_type = data
-        packing = Packing(bin_size, polygons)
-        time1 = time.time()
-        packing.nest_all(True, algo, figures_sorting_type, algo_extra)
-        print('Bins used:', len(packing.bins))
-        print('Time:', time.time() - time1)
-        fit = fitness(packing.bins, packing.bin_size, packing.coeffs)
-        print('Fitness-function value:', fit)
+        if algo == 'parallel tempering':  # keys override the parameters of the input file
+            for i, value in ((2, namespace.chains), (3, namespace.exchange_interval), (4, namespace.seed)):
+                if value is not None:
+                    algo_extra[i] = value
+        elif algo == 'genetic' and namespace.seed is not None:
+            algo_extra[3] = namespace.seed
+        bins = None
+        if namespace.resume is not None:  # the saved packing is completed (and improved, depending on the algorithm)
+            saved_bin_size, bins = load_packing(namespace.resume)
+            if tuple(saved_bin_size) != tuple(bin_size):
+                raise ValueError('bin size of the saved packing {} is not the bin size of the input file {}'.format(saved_bin_size, bin_size))
+        packing = Packing(bin_size, polygons, bins)
+        # when a format which can be loaded back is written to stdout, messages go to stderr so they don't corrupt it
+        messages = sys.stderr if namespace.output == 'stdout' and namespace.format != 'repr' else sys.stdout
+        with redirect_stdout(messages):
+            if namespace.profile is not None:
+                collector = enable_stats()
+            time1 = time.time()
+            packing.nest_all(True, algo, figures_sorting_type, algo_extra, namespace.jobs, namespace.time_budget, namespace.max_iterations)
+            print('Bins used:', len(packing.bins))
+            print('Time:', time.time() - time1)
+            fit = fitness(packing.bins, packing.bin_size, packing.coeffs)
+            print('Fitness-function value:', fit)
+            if namespace.profile is not None:
+                write_report(collector, namespace.profile)
         if namespace.output == 'stdout':
-            print('Bins:', packing.bins, sep='\n')
+            if namespace.format == 'repr':
+                print('Bins:', packing.unscaled_bins(), sep='\n')
+            else:
+                save_packing(packing, sys.stdout.buffer if namespace.format == 'npz' else sys.stdout, namespace.format)
         else:
-            with open(namespace.output, 'w') as f:
-                f.write(str(packing.bins))
+            with open(namespace.output, 'wb' if namespace.format == 'npz' else 'w') as f:
+                save_packing(packing, f, namespace.format)
         if namespace.plot:
+            from prog.visualize import plot_packing  # matplotlib is only imported when a plot is asked
             plot_packing(packing, 10)
     elif mode == 'autogenerator':
         time1 = time.time()
-        filenames, calculate, path = autogenerate_files(data)
-        print('Generation time:', time.time() - time1)
+        jobs, calculate, path = autogenerate_files(data, not namespace.no_files)
         if calculate.split()[0] == 'yes':
+            # jobs are generated (and files written) while the first ones are being calculated
             infofilename = calculate.split()[1]
-            time1 = time.time()
-            make_calculations(filenames, infofilename, path)
+            make_calculations(jobs, infofilename, path, namespace.nfp_cache, namespace.fitness_backend,
+                              namespace.workers, namespace.job_timeout, namespace.profile is not None,
+                              namespace.placement)
             print('Calculation time:', time.time() - time1)
+        else:
+            for _ in jobs:
+                pass
+            print('Generation time:', time.time() - time1)
         # delete_autogenerated_files()
 
 if __name__ == '__main__':
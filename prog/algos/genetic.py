@@ -0,0 +1,241 @@
+import copy
+import os
+import random
+import time
+import numpy as np
+from multiprocessing import Pool
+
+from prog.container import Bin
+from prog.fitness import fitness, set_fitness_backend, get_fitness_backend
+from prog.nfp import find_best_nfp_pt, set_nfp_store, set_placement_policy, get_placement_policy
+from prog.prefix_cache import PrefixCache, PREFIX_CACHE_BYTES
+from prog import stats
+import prog.nfp
+
+ELITE = 2  # number of best genomes copied unchanged to the next generation
+TOURNAMENT = 3  # number of genomes drawn to select a parent, the best one wins
+DECODER_PACKING = None  # packing without new polygons used by `evaluate_genome` in the current process, see `init_decoder_worker`
+DECODER_CACHE = None  # `PrefixCache` of the genomes decoded by the current process
+
+
+def init_decoder_worker(packing, nfp_store_path, fitness_backend, placement_policy='bottom left', profile=False):
+    """initializer of worker processes, they keep the packing (polygons, orientations, bin size), their nfp caches
+    and the prefixes of decoded genomes between generations. With `profile`, they collect stats, sent with each fitness
+    """
+    global DECODER_PACKING, DECODER_CACHE
+    DECODER_PACKING = packing
+    DECODER_CACHE = PrefixCache() if PREFIX_CACHE_BYTES else None
+    set_nfp_store(nfp_store_path)
+    set_fitness_backend(fitness_backend)
+    set_placement_policy(placement_policy)
+    if profile:
+        stats.enable_stats()
+
+
+def decode_genome(packing, genome, cache=None):
+    """Nests the polygons of `genome` (rows (part id, orientation id)) in this order into the bins of `packing`, first bin where they fit:
+    each polygon is placed at its best position (see `prog.nfp.find_best_nfp_pt`) in the first bin where it has one, or in a new bin.
+    With a `PrefixCache`, the placements of the longest prefix of `genome` already decoded are replayed without any nfp query,
+    and the placements of `genome` are saved in the cache. Returns the length of the replayed prefix
+    Replayed bins have no cached nfp unions (see `prog.nfp.get_nfp_union`), the next queries build them at once instead of polygon by polygon,
+    and clipper rounding can make them differ by one fixed point unit: the result can depend on the genomes decoded before by the cache
+    """
+    orientations = packing.orientations
+    depth, record = (0, None) if cache is None else cache.lookup(genome)
+    bin_ids, translations = [], []
+    for k, (part_id, orient_id) in enumerate(genome):
+        polygon = orientations.parts[part_id]
+        transformed_polygon = orientations.variant(part_id, orient_id)
+        if k < depth:
+            bin_id, translation = record.bin_ids[k], record.translations[k]
+            if bin_id == len(packing.bins):
+                packing.bins.append(Bin())
+            packing.bins[bin_id].append((polygon, transformed_polygon, translation))
+        else:
+            for bin_id, abin in enumerate(packing.bins):
+                if not abin.may_fit(transformed_polygon, packing.bin_size):
+                    continue
+                translation = find_best_nfp_pt(abin, packing.bin_size, transformed_polygon)
+                if translation is not None:
+                    abin.append((polygon, transformed_polygon, translation))
+                    break
+            else:
+                bin_id, translation = len(packing.bins), np.zeros(2)
+                packing.bins.append(Bin([(polygon, transformed_polygon, translation)]))
+        bin_ids.append(bin_id)
+        translations.append(translation)
+    if cache is not None:
+        cache.insert(genome, bin_ids, translations)
+        stats.count('prefix cache replayed placements', depth)
+    return depth
+
+
+def evaluate_genome(genome):
+    """decodes `genome` into a copy of the worker packing,
+    returns (fitness of the result, number of placements replayed from the prefix cache, (process id, report of this cache) or None,
+    stats of the decoding or None, see `prog.stats.collect`)
+    """
+    packing = copy.copy(DECODER_PACKING)
+    packing.bins = [Bin(abin) for abin in DECODER_PACKING.bins]
+    depth = decode_genome(packing, genome, DECODER_CACHE)
+    stats.count('ga genome decoded')
+    report = (os.getpid(), DECODER_CACHE.report()) if DECODER_CACHE is not None else None
+    fit = fitness(packing.bins, packing.bin_size, packing.coeffs)
+    return fit, depth, report, stats.collect()
+
+
+class Genetic:
+    """Genetic algorithm over nesting orders: a genome is the sequence of the remaining polygons with their orientations,
+    decoded by the bottom left first fit placement (see `decode_genome`).
+    Each generation keeps the ELITE best genomes, other children are made by order crossover of two parents selected by tournament,
+    then mutated (swap of two polygons, change of an orientation). Genomes are evaluated in a process pool,
+    and their fitnesses are kept by genome, so an unchanged or duplicated genome is never decoded twice
+    """
+
+    def __init__(self, packing, sort, population_size, generations, mutation_rate, seed=None, workers=1):
+        self.packing = packing
+        self.sort = sort
+        self.population_size = population_size
+        self.generations = generations
+        self.mutation_rate = mutation_rate  # probability of each of the two mutations of a child
+        self.seed = seed
+        self.workers = workers  # number of processes, 1 means that genomes are decoded in this process
+        self.rng = np.random.RandomState(seed)
+        orientations = packing.orientations
+        # part id, orientation id: first orientation id with the same polygon (e.g. a symmetric part has less than 8 distinct orientations),
+        # genes are mapped to it so that genomes which nest the same polygons have the same bytes
+        self.canonical = np.array([orientations.canonical_ids(part_id) for part_id in range(len(orientations.parts))], dtype=np.int32).reshape(-1, 8)
+        self.fitnesses = {}  # genome bytes: fitness
+        self.decoded = 0  # number of genomes decoded
+        self.cache_hits = 0  # number of genomes whose fitness was known
+        self.placements = 0  # number of polygons placed by decoded genomes
+        self.replayed = 0  # number of these placements replayed from the prefix caches of the decoders, see `decode_genome`
+        self.prefix_reports = {}  # process id of a decoder: last report of its prefix cache
+        self.generation = 0  # number of generations made
+
+    def initial_genome(self):
+        """polygons in the order of the initial nesting (see `Packing.make_initial_nesting`), without transformation"""
+        orientations = self.packing.orientations
+        if self.sort == 'random':
+            remaining = dict(self.packing.remaining)
+            order = []
+            while remaining:
+                polygon = random.choice(list(remaining.keys()))
+                order.append(polygon)
+                remaining[polygon] -= 1
+                if not remaining[polygon]:
+                    remaining.pop(polygon)
+        else:
+            polygons = sorted(self.packing.remaining.items(), key=lambda pg: orientations.areas[orientations.part_id(pg[0])], reverse=True)
+            order = [polygon for polygon, count in polygons for _ in range(count)]
+        return np.array([(orientations.part_id(polygon), 0) for polygon in order], dtype=np.int32).reshape(-1, 2)
+
+    def random_genome(self, genome):
+        """`genome` shuffled, with random orientations"""
+        genome = genome[self.rng.permutation(len(genome))]
+        genome[:, 1] = self.canonical[genome[:, 0], self.rng.randint(0, 8, len(genome))]
+        return genome
+
+    def crossover(self, parent1, parent2):
+        """order crossover: a random slice of `parent1` is kept in place, other places are filled with the remaining polygons in the order of `parent2`"""
+        n = len(parent1)
+        start, stop = sorted(self.rng.randint(0, n + 1, 2))
+        child = parent1.copy()
+        needed = np.bincount(parent1[:, 0], minlength=len(self.packing.orientations.parts))
+        needed -= np.bincount(parent1[start:stop, 0], minlength=len(needed))
+        fill = []
+        for gene in parent2:
+            if needed[gene[0]] > 0:
+                needed[gene[0]] -= 1
+                fill.append(gene)
+        places = list(range(start)) + list(range(stop, n))
+        if places:
+            child[places] = fill
+        return child
+
+    def mutate(self, genome):
+        if len(genome) > 1 and self.rng.random_sample() < self.mutation_rate:
+            i, j = self.rng.choice(len(genome), 2, replace=False)
+            genome[[i, j]] = genome[[j, i]]
+        if len(genome) and self.rng.random_sample() < self.mutation_rate:
+            orient_id = self.rng.randint(0, 8)
+            k = self.rng.randint(len(genome))
+            genome[k, 1] = self.canonical[genome[k, 0], orient_id]
+        return genome
+
+    def select(self, population, scores):
+        contestants = self.rng.randint(0, len(population), TOURNAMENT)
+        return population[max(contestants, key=lambda k: scores[k])]
+
+    def evaluate(self, population, pool):
+        """returns the fitnesses of `population`, only genomes never met before are decoded"""
+        keys = [genome.tobytes() for genome in population]
+        new = {}
+        for key, genome in zip(keys, population):
+            if key not in self.fitnesses and key not in new:
+                new[key] = genome
+        self.cache_hits += len(keys) - len(new)
+        stats.count('ga fitness cache hit', len(keys) - len(new))
+        results = pool.map(evaluate_genome, list(new.values())) if pool is not None else map(evaluate_genome, new.values())
+        for (key, genome), (fit, depth, report, genome_stats) in zip(new.items(), results):
+            stats.merge(genome_stats)
+            self.fitnesses[key] = fit
+            self.placements += len(genome)
+            self.replayed += depth
+            if report is not None:
+                self.prefix_reports[report[0]] = report[1]
+        self.decoded += len(new)
+        return [self.fitnesses[key] for key in keys]
+
+    def prefix_report(self):
+        """reports of the prefix caches of all decoders summed up (memory is the largest one), or None without prefix cache"""
+        reports = list(self.prefix_reports.values())
+        if not reports:
+            return None
+        hits = sum(report['hits'] for report in reports)
+        return {'lookups': sum(report['lookups'] for report in reports), 'hits': hits,
+                'mean_hit_depth': sum(report['mean_hit_depth'] * report['hits'] for report in reports) / hits if hits else 0.0,
+                'max_hit_depth': max(report['max_hit_depth'] for report in reports),
+                'genomes': sum(report['genomes'] for report in reports), 'nodes': sum(report['nodes'] for report in reports),
+                'memory': max(report['memory'] for report in reports)}
+
+    def genetic(self, time_budget=None, max_generations=None):
+        """Evolves the population during `generations` generations (or `max_generations` if it is lower), or until `time_budget` seconds
+        have elapsed, then nests the best genome met. Returns (fitness of the initial order decoded by `decode_genome`, best fitness)
+        """
+        global DECODER_PACKING, DECODER_CACHE
+        start_time = time.perf_counter()
+        if self.seed is not None:  # the initial order is random too with random sort
+            random.seed(self.seed)
+        generations = self.generations if max_generations is None else min(self.generations, max_generations)
+        template = copy.copy(self.packing)
+        template.bins = [Bin(abin) for abin in self.packing.bins]
+        first = self.initial_genome()
+        population = [first] + [self.random_genome(first) for _ in range(self.population_size - 1)]
+        pool = None
+        if self.workers > 1:
+            pool = Pool(self.workers, initializer=init_decoder_worker,
+                        initargs=(template, prog.nfp.NFP_STORE_PATH, get_fitness_backend(), get_placement_policy(), stats.STATS is not None))
+        else:
+            init_decoder_worker(template, prog.nfp.NFP_STORE_PATH, get_fitness_backend(), get_placement_policy())
+        try:
+            scores = self.evaluate(population, pool)
+            first_fitness = scores[0]
+            while self.generation < generations and (time_budget is None or time.perf_counter() - start_time < time_budget):
+                ranking = sorted(range(len(population)), key=lambda k: scores[k], reverse=True)
+                children = [population[k] for k in ranking[:ELITE]]
+                while len(children) < self.population_size:
+                    children.append(self.mutate(self.crossover(self.select(population, scores), self.select(population, scores))))
+                population = children
+                scores = self.evaluate(population, pool)
+                self.generation += 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            else:  # the packing and the prefix cache of this process are not kept after the run
+                DECODER_PACKING, DECODER_CACHE = None, None
+        best = population[int(np.argmax(scores))]
+        decode_genome(self.packing, best)
+        self.packing.remaining = {}
+        return first_fitness, max(scores)
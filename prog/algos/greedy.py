@@ -1,75 +1,176 @@
 import numpy as np
 import random
-from prog.transform import apply_transformations
-from prog.nfp import find_nfp
-from prog.fitness import fitness
-from shapely.geometry import Polygon
-import copy
+from prog.transform import ORIENTATIONS
+from prog.nfp import find_best_nfp_pt, set_nfp_store, set_placement_policy, get_placement_policy
+from prog.fitness import FitnessEvaluator
+from prog.container import Bin
+from prog import stats
+from collections import namedtuple
+from multiprocessing import Process, Pipe
+import prog.nfp
+
+# proposed placement of a polygon: index of the bin, index of the transformation (see `Greedy.greedy_step`), translation in the bin
+Placement = namedtuple('Placement', ['bin_idx', 'orientation', 'translation'])
+
+
+def serve_queries(connection, bin_size, nfp_store_path, placement_policy, profile=False):
+    """Worker process of the parallel greedy mode: keeps a copy of the bins (and so the nfp unions of its queries and its minkowski sums)
+    and answers the nfp queries it is sent at each step, see class QueryWorkers. With `profile`, stats are sent with each answer
+    """
+    set_nfp_store(nfp_store_path)
+    set_placement_policy(placement_policy)
+    if profile:
+        stats.enable_stats()
+    bins = []
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        placements, transformed_polygons, queries = task
+        for bin_idx, placement in placements:
+            if bin_idx == len(bins):
+                bins.append(Bin())
+            bins[bin_idx].append(placement)
+        best_pts = [find_best_nfp_pt(bins[bin_idx], bin_size, transformed_polygons[i]) for bin_idx, i in queries]
+        connection.send((best_pts, stats.collect()))
+    connection.close()
+
+
+class QueryWorkers:
+    """Processes answering the (bin, transformation) nfp queries of the greedy algorithm
+    Every worker gets all placements, and the query (bin b, transformation i) is always sent to the worker (8 b + i) % workers,
+    so queries are balanced between workers and the nfp unions of a (bin, transformation) pair are only computed by one worker
+    """
+
+    def __init__(self, packing, workers):
+        self.bin_size = packing.bin_size
+        self.connections = []
+        self.processes = []
+        for _ in range(workers):
+            connection, worker_connection = Pipe()
+            process = Process(target=serve_queries, daemon=True,
+                              args=(worker_connection, packing.bin_size, prog.nfp.NFP_STORE_PATH, get_placement_policy(), stats.STATS is not None))
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.placements = [(bin_idx, placement) for bin_idx, abin in enumerate(packing.bins) for placement in abin]  # not sent yet
+
+    def place(self, bin_idx, placement):
+        """`placement` was appended to the bin `bin_idx` (possibly a new bin)"""
+        self.placements.append((bin_idx, placement))
+
+    def query(self, transformed_polygons, queries):
+        """returns the best positions of `queries` (bin index, transformation index), in the order of `queries`"""
+        workers = len(self.connections)
+        owner = lambda query: (len(transformed_polygons) * query[0] + query[1]) % workers
+        shares = [[] for _ in range(workers)]
+        for query in queries:
+            shares[owner(query)].append(query)
+        for connection, share in zip(self.connections, shares):
+            connection.send((self.placements, transformed_polygons, share))
+        self.placements = []
+        answers = []
+        for connection in self.connections:
+            best_pts, worker_stats = connection.recv()
+            stats.merge(worker_stats)
+            answers.append(iter(best_pts))
+        return [next(answers[owner(query)]) for query in queries]
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+            connection.close()
+        for process in self.processes:
+            process.join()
+
 
 class Greedy:
-    def __init__(self, packing, sort):
+    def __init__(self, packing, sort, workers=1):
         self.packing = packing
         self.sort = sort
+        self.evaluator = FitnessEvaluator(packing.bin_size, packing.coeffs, packing.bins)
+        self.workers = workers  # number of processes computing nfps, 1 means serial mode
+        self.pool = None  # `QueryWorkers` in parallel mode
+        self.nfp_queries = 0  # number of (bin, transformation) pairs considered
+        self.pruned_queries = 0  # number of these pairs skipped without computing the nfp, see `Bin.may_fit`
         
     def greedy(self):
         """Will nest the input polygon if the initial quantity for this polygon hasn't been reached yet"""
+        if self.workers > 1:
+            # nfp queries hold the GIL (clipper and Python code), so they are run by processes which keep their own copies of the bins
+            self.pool = QueryWorkers(self.packing, self.workers)
+            try:
+                self.nest_remaining()
+            finally:
+                self.pool.close()
+                self.pool = None
+        else:
+            self.nest_remaining()
+
+    def nest_remaining(self):
         if self.sort == 'random':
             while self.packing.remaining:
                 polygon = random.choice(list(self.packing.remaining.keys()))
                 self.greedy_step(polygon)
         elif self.sort == 'descending area':
-            polygons = dict(sorted(self.packing.remaining.items(), key=lambda pg: Polygon(pg[0]).area, reverse=True))
+            polygons = dict(sorted(self.packing.remaining.items(), key=lambda pg: self.packing.orientations.areas[self.packing.orientations.part_id(pg[0])], reverse=True))
             for polygon in polygons:
                 for _ in range(self.packing.remaining[polygon]):
                     self.greedy_step(polygon)
 
+    @stats.timed('greedy step')
     def greedy_step(self, polygon):
-        transformed_polygons = [apply_transformations(polygon, flip, rotation) for flip in (False, True) for rotation in (0, 90, 180, 270)]
-        flag = []
-        bbins = []
+        # the 8 orientations of the polygon (orientation ids 0 to 7), computed once when the instance was loaded
+        transformed_polygons = self.packing.orientations.variants[self.packing.orientations.part_id(polygon)][:len(ORIENTATIONS)]
+        queries = [(abinidx, i) for abinidx in range(len(self.packing.bins)) for i in range(len(transformed_polygons))]
+        # pairs where the transformed polygon can't fit (no position in the bin at a previous step, not enough free area, or too large) are skipped
+        skipped = set(query for query in queries 
+                      if not self.packing.bins[query[0]].may_fit(transformed_polygons[query[1]], self.packing.bin_size))
+        self.nfp_queries += len(queries)
+        self.pruned_queries += len(skipped)
+        stats.count('nfp query pruned', len(skipped))
+        # each query only returns the best position of the transformed polygon in the bin (see `find_best_nfp_pt`), or None
+        query_nfp = lambda query: None if query in skipped else find_best_nfp_pt(self.packing.bins[query[0]], self.packing.bin_size, transformed_polygons[query[1]])
+        # (bin, transformation) queries are independent, results are gathered in the order of the queries, as in serial mode
+        if self.pool is not None:
+            pending = [query for query in queries if query not in skipped]
+            answers = dict(zip(pending, self.pool.query(transformed_polygons, pending)))
+            for (abinidx, i), best_pt in answers.items():
+                if best_pt is None:  # the bins of the workers keep it, so do the bins of the packing
+                    self.packing.bins[abinidx].reject(transformed_polygons[i])
+            best_pts = iter([answers.get(query) for query in queries])
+        else:
+            best_pts = map(query_nfp, queries)
+        best_fit = -1
+        best_placement = None
         for abinidx in range(len(self.packing.bins)):
-            valid_pts_list = []
-            transformed_polygons_ = copy.deepcopy(transformed_polygons)
+            candidates = []
             for i in range(len(transformed_polygons)):
-                nfp = find_nfp(self.packing.bins[abinidx], self.packing.bin_size, transformed_polygons[i])
-                if len(nfp):
-                    valid_pts_list.append(nfp)
-                else:
-                    transformed_polygons_[i] = -1
-            if len(valid_pts_list):
-                #valid_pts_list = np.reshape(np.array(valid_pts_list), -1)
-                #valid_pts_list = valid_pts_list.reshape(valid_pts_list.shape[0] // 2, 2)
-                #valid_pts_list = np.unique(valid_pts_list, axis=0)
-                transformed_polygons_ = [x for x in transformed_polygons_ if x != -1]
-                bins = [copy.deepcopy(self.packing.bins) for _ in range(len(valid_pts_list))]
-                fit = []
-                for j in range(len(valid_pts_list)):
-                    best_pts = list(valid_pts_list[j])
-                    best_pts.sort(key=lambda x: x[0])
-                    best_pts.sort(key=lambda x: x[1])
-                    best_pt = best_pts[0]
-                    bins[j][abinidx].append((polygon, transformed_polygons_[j], best_pt))
-                    ff = fitness(bins[j], self.packing.bin_size, self.packing.coeffs)
-                    fit.append((ff, best_pt, j))
-                fit.sort(key=lambda x: x[1][0])
-                fit.sort(key=lambda x: x[1][1])
-                fit.sort(key=lambda x: x[0], reverse=True)
-                bbins.append(bins[fit[0][2]])
-            else:
-                flag.append(1)
-        if len(flag) == len(self.packing.bins):  # if else statement is executed, it means that the polygon did not fit in any existing bins, we need to add a new bin
+                best_pt = next(best_pts)
+                if best_pt is not None:
+                    # candidates are scored against the live packing, nothing is copied
+                    ff = self.evaluator.propose(abinidx, transformed_polygons[i], best_pt)
+                    candidates.append((ff, Placement(abinidx, i, best_pt)))
+            if candidates:
+                # best fitness first, then lowest and leftmost translation, then first orientation
+                ff, placement = min(candidates, key=lambda x: (-x[0], x[1].translation[1], x[1].translation[0]))
+                if ff > best_fit:
+                    best_fit = ff
+                    best_placement = placement
+        if best_placement is None:  # it means that the polygon did not fit in any existing bins, we need to add a new bin
             # TODO: check if polygon fits alone in a new bin
-            self.packing.bins.append([(polygon, polygon, np.zeros(2))])
+            self.packing.bins.append(Bin([(polygon, polygon, np.zeros(2))]))
+            self.evaluator.update(self.packing.bins)
+            if self.pool is not None:
+                self.pool.place(len(self.packing.bins) - 1, self.packing.bins[-1][0])
         else:
-            maxi = -1
-            bestbins = []
-            for bins in bbins:
-                fit = fitness(bins, self.packing.bin_size, self.packing.coeffs)
-                if fit > maxi:
-                    maxi = fit
-                    bestbins = bins
-            self.packing.bins = bestbins
-        
+            abinidx, i, translation = best_placement
+            self.packing.bins[abinidx].append((polygon, transformed_polygons[i], translation))
+            self.evaluator.update(self.packing.bins, (abinidx, ))
+            if self.pool is not None:
+                self.pool.place(abinidx, self.packing.bins[abinidx][-1])
+
         self.packing.remaining[polygon] -= 1
         if self.sort == 'random' and (not self.packing.remaining[polygon]):
             self.packing.remaining.pop(polygon)
@@ -0,0 +1,121 @@
+import copy
+import random
+import numpy as np
+from multiprocessing import Pool
+
+from prog.algos.simulated_annealing import SA
+from prog.snapshot import PlacementSnapshot
+from prog.nfp import set_nfp_store, set_placement_policy, get_placement_policy
+from prog.fitness import set_fitness_backend, get_fitness_backend
+from prog import stats
+import prog.nfp
+
+LADDER_RATIO = 0.5  # initial temperature of chain k is initial temperature * LADDER_RATIO ** k
+CHAIN_PACKING = None  # packing without bins used by `run_chain_segment` in the current process, see `init_chain_worker`
+
+
+def init_chain_worker(packing, nfp_store_path, fitness_backend, placement_policy='bottom left', profile=False):
+    """initializer of worker processes, they keep the packing (polygons, orientations, bin size) and their nfp caches between segments
+    With `profile`, they collect stats, sent with the result of each segment (see `prog.stats.collect`)
+    """
+    global CHAIN_PACKING
+    CHAIN_PACKING = packing
+    set_nfp_store(nfp_store_path)
+    set_fitness_backend(fitness_backend)
+    set_placement_policy(placement_policy)
+    if profile:
+        stats.enable_stats()
+
+
+def run_chain_segment(task):
+    """Runs at most `steps` moves of simulated annealing from the bins `arrays` (see `PlacementSnapshot.to_arrays`) at `temperature`
+    Returns (bins at the end, energy, temperature, changes count, best bins of the segment, best energy, stats of the segment or None)
+    """
+    arrays, sort, temperature, decrease_rate, steps, seed = task
+    packing = copy.copy(CHAIN_PACKING)
+    packing.bins = PlacementSnapshot.from_arrays(arrays, packing.orientations).to_bins()
+    annealer = SA(packing, sort, temperature, decrease_rate)
+    annealer.temperature = temperature
+    annealer.start()
+    np.random.seed(seed)
+    best, best_energy = arrays, annealer.energy
+    for _ in range(steps):
+        if annealer.temperature <= 0:
+            break
+        annealer.step()
+        if annealer.energy < best_energy:
+            best, best_energy = packing.placements().to_arrays(), annealer.energy
+    return (packing.placements().to_arrays(), annealer.energy, annealer.temperature, annealer.sum_changes, best, best_energy,
+            stats.collect())
+
+
+class ParallelTempering:
+    """Simulated annealing with several chains (aka parallel tempering or replica exchange)
+    Chain k starts at the temperature init_temp * LADDER_RATIO ** k and cools down at a proportional rate, so all chains end together.
+    Chains run `exchange_interval` moves in parallel (one task per chain in a process pool), then the states of neighbouring chains
+    are swapped with the replica exchange probability min(1, exp((E_k - E_k+1) * (1 / T_k - 1 / T_k+1))).
+    The best packing met by any chain is kept
+    """
+
+    def __init__(self, packing, sort, init_temp, temp_decr_rate, chains=4, exchange_interval=100, seed=None, workers=1):
+        self.packing = packing
+        self.sort = sort
+        self.init_temp = init_temp
+        self.temp_decr_rate = temp_decr_rate
+        self.chains = chains
+        self.exchange_interval = exchange_interval
+        self.seed = seed
+        self.workers = workers  # number of processes, 1 means that chains run one after the other in this process
+        self.rng = np.random.RandomState(seed)  # used for the exchanges and the seeds of the chain segments
+        self.exchanges = 0  # number of accepted swaps between chains
+        self.exchange_attempts = 0
+
+    def parallel_tempering(self):
+        """Nests all polygons, returns (sum of changes of all chains, initial fitness, best fitness)"""
+        if self.seed is not None:  # the initial nesting is random too
+            random.seed(self.seed)
+        self.packing.make_initial_nesting(self.sort)
+        init_fitness = SA(self.packing, self.sort, self.init_temp, self.temp_decr_rate).start()
+        template = copy.copy(self.packing)
+        template.bins = []
+        arrays = self.packing.placements().to_arrays()
+        energy = 100000 * (1 - init_fitness)
+        # state of each chain: [bins arrays, energy, temperature, decrease rate]
+        states = [[arrays, energy, self.init_temp * LADDER_RATIO ** k, self.temp_decr_rate * LADDER_RATIO ** k] for k in range(self.chains)]
+        best, best_energy = arrays, energy
+        sum_changes = 0
+        pool = None
+        if self.workers > 1:
+            pool = Pool(min(self.workers, self.chains), initializer=init_chain_worker,
+                        initargs=(template, prog.nfp.NFP_STORE_PATH, get_fitness_backend(), get_placement_policy(), stats.STATS is not None))
+        else:
+            init_chain_worker(template, prog.nfp.NFP_STORE_PATH, get_fitness_backend(), get_placement_policy())
+        try:
+            while any(state[2] > 0 for state in states):
+                active = [k for k in range(self.chains) if states[k][2] > 0]
+                tasks = [(states[k][0], self.sort, states[k][2], states[k][3], self.exchange_interval, self.rng.randint(2 ** 31)) for k in active]
+                results = pool.map(run_chain_segment, tasks) if pool is not None else map(run_chain_segment, tasks)
+                for k, (arrays, energy, temperature, changes, segment_best, segment_best_energy, segment_stats) in zip(active, results):
+                    stats.merge(segment_stats)
+                    states[k][:3] = [arrays, energy, temperature]
+                    sum_changes += changes
+                    if segment_best_energy < best_energy:
+                        best, best_energy = segment_best, segment_best_energy
+                self.exchange(states)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.packing.bins = PlacementSnapshot.from_arrays(best, self.packing.orientations).to_bins()
+        return sum_changes, init_fitness, 1 - best_energy / 100000
+
+    def exchange(self, states):
+        """swaps the bins of neighbouring chains which are still running, with the replica exchange probability"""
+        for k in range(len(states) - 1):
+            (_, energy1, temperature1, _), (_, energy2, temperature2, _) = states[k], states[k + 1]
+            if temperature1 <= 0 or temperature2 <= 0:
+                continue
+            self.exchange_attempts += 1
+            if self.rng.random_sample() < np.exp(min(0, (energy1 - energy2) * (1 / temperature1 - 1 / temperature2))):
+                states[k][:2], states[k + 1][:2] = states[k + 1][:2], states[k][:2]
+                self.exchanges += 1
@@ -1,8 +1,15 @@
+import time
 import numpy as np
-from prog.transform import apply_transformations
-from prog.nfp import find_nfp
-from prog.fitness import fitness
-import copy
+from collections import namedtuple
+from prog.nfp import find_best_nfp_pt
+from prog.fitness import FitnessEvaluator
+from prog import stats
+
+ADAPT_INTERVAL = 20  # number of moves between two updates of the decrease rate, see `SA.budgeted_annealing`
+REJECTED_DECREASE = 0.1  # a rejected or impossible move decreases the temperature by this fraction of the decrease rate
+
+# state of a budgeted annealing given to the progress callback, see `SA.budgeted_annealing`
+Progress = namedtuple('Progress', ['iterations', 'elapsed', 'temperature', 'acceptance', 'fitness', 'best_fitness'])
 
 class SA:
     def __init__(self, packing, sort, init_temp, temp_decr_rate):
@@ -10,20 +17,28 @@ class SA:
         self.sort = sort
         self.init_temp = init_temp
         self.temp_decr_rate = temp_decr_rate
+        # changes made in place by the current move, so it can be undone if rejected: 
+        # ('unions', bin index, nfp unions of the bin before the move), ('append', bin index) or ('pop', bin index, polygon index, polygon)
+        self.journal = []
+        self.iterations = 0  # number of moves made by `budgeted_annealing`
+        self.best_fitness = None  # fitness of the packing kept by `budgeted_annealing`
         
-    def nest_polygon_to_a_bin(self, polygon, abin):
+    def nest_polygon_to_a_bin(self, polygon, binidx):
         """Will nest the input polygon if the initial quantity for this polygon hasn't been reached yet"""        
+        abin = self.packing.bins[binidx]
         flip = np.random.choice([True, False])
         rotation = np.random.choice([0, 90, 180, 270])
-        transformed_polygon = apply_transformations(polygon[1], flip, rotation)
-        valid_pts = find_nfp(abin, self.packing.bin_size, transformed_polygon)
-        if len(valid_pts):
-            best_pts = list(valid_pts)
-            best_pts.sort(key=lambda x: x[0])
-            best_pts.sort(key=lambda x: x[1])
-            best_pt = best_pts[0]
+        # the current orientation of the polygon is transformed, its result is looked up in the orientation table
+        orientations = self.packing.orientations
+        part_id = orientations.part_id(polygon[0])
+        orient_id = orientations.transform(part_id, orientations.orient_id(part_id, polygon[1]), flip, rotation)
+        transformed_polygon = orientations.variant(part_id, orient_id)
+        best_pt = find_best_nfp_pt(abin, self.packing.bin_size, transformed_polygon)
+        if best_pt is not None:
             polygon = (polygon[0], transformed_polygon, best_pt)
+            self.save_unions(binidx)
             abin.append(polygon)
+            self.journal.append(('append', binidx))
             return True
         else:
             return False
@@ -38,39 +53,128 @@ class SA:
     #             return -1
         
     def make_a_swap_move(self):
-        bins = copy.deepcopy(self.packing.bins)
+        """Swaps two random polygons in place, returns the indices of the two bins touched by the move or "error" if the swap is impossible
+        The move can be undone with `undo_move` until the next move is made
+        """
+        bins = self.packing.bins
+        self.journal = []
         binidx1 = np.random.randint(0, len(bins))
         binidx2 = np.random.randint(0, len(bins))
         polyidx1 = np.random.randint(0, len(bins[binidx1]))
         polyidx2 = np.random.randint(0, len(bins[binidx2]))
-        if self.nest_polygon_to_a_bin(bins[binidx1][polyidx1], bins[binidx2]) and self.nest_polygon_to_a_bin(bins[binidx2][polyidx2], bins[binidx1]):
-            bins[binidx1].pop(polyidx1)
-            bins[binidx2].pop(polyidx2)
-            return bins
+        if self.nest_polygon_to_a_bin(bins[binidx1][polyidx1], binidx2) and self.nest_polygon_to_a_bin(bins[binidx2][polyidx2], binidx1):
+            self.pop_polygon(binidx1, polyidx1)
+            self.pop_polygon(binidx2, polyidx2)
+            return binidx1, binidx2
         else:
+            self.undo_move()
             return "error"
+
+    def pop_polygon(self, binidx, polyidx):
+        self.save_unions(binidx)
+        self.journal.append(('pop', binidx, polyidx, self.packing.bins[binidx].pop(polyidx)))
+
+    def save_unions(self, binidx):
+        """keeps a copy of the nfp unions of the bin before its first change in the current move, they are still valid once the move is undone"""
+        if not any(entry[0] == 'unions' and entry[1] == binidx for entry in self.journal):
+            self.journal.append(('unions', binidx, dict(self.packing.bins[binidx].nfp_unions)))
+
+    def undo_move(self):
+        """Restores the bins as they were before the current move, in time proportional to the bins touched by the move"""
+        bins = self.packing.bins
+        for entry in reversed(self.journal):
+            if entry[0] == 'append':
+                bins[entry[1]].pop()
+            elif entry[0] == 'pop':
+                _, binidx, polyidx, polygon = entry
+                bins[binidx].insert(polyidx, polygon)
+            else:
+                _, binidx, nfp_unions = entry
+                bins[binidx].nfp_unions = nfp_unions
+        self.journal = []
             
-    def simulated_annealing(self):
+    def simulated_annealing(self, time_budget=None, max_iterations=None, callback=None):
+        """Nests all polygons then anneals them until the temperature reaches 0,
+        or with a budget of time (in seconds, initial nesting included) and/or of moves, see `budgeted_annealing`
+        """
+        start_time = time.perf_counter()
         self.packing.make_initial_nesting(self.sort)
-        temperature = self.init_temp
-        init_fitness = fitness(self.packing.bins, self.packing.bin_size, self.packing.coeffs)
-        energy = 100000 * (1 - fitness(self.packing.bins, self.packing.bin_size, self.packing.coeffs))
-        sum_changes = 0
-        poss_changes = 0
-        while temperature > 0:
-            bins = self.make_a_swap_move()
-            if bins != 'error':
-                possible_new_energy = 100000 * (1 - fitness(bins, self.packing.bin_size, self.packing.coeffs))
-                energy_diff = possible_new_energy - energy
-                if energy_diff < 0 or np.random.random() < np.exp(-energy_diff / temperature):
-                    sum_changes += 1
-                    if energy_diff >= 0:
-                        poss_changes += 1
-                    self.packing.bins = bins
-                    energy = possible_new_energy
-                    temperature -= self.temp_decr_rate
-                else:
-                    temperature -= self.temp_decr_rate * 0.1
+        self.temperature = self.init_temp
+        init_fitness = self.start()
+        if time_budget is None and max_iterations is None:
+            while self.temperature > 0:
+                self.step()
+        else:
+            if time_budget is not None:
+                time_budget -= time.perf_counter() - start_time
+            self.budgeted_annealing(time_budget, max_iterations, callback)
+        return self.sum_changes, self.poss_changes, init_fitness
+
+    def budgeted_annealing(self, time_budget=None, max_iterations=None, callback=None):
+        """Anytime annealing: makes moves until the temperature reaches 0, `time_budget` seconds have elapsed or `max_iterations` moves are made,
+        then restores the best packing met.
+        Every ADAPT_INTERVAL moves, the decrease rate is set so that the temperature reaches 0 at the end of the budget:
+        the number of remaining moves is estimated from the mean duration of a move, and the expected decrease per move
+        from the acceptance ratio of the last moves (rejected moves only decrease the temperature by REJECTED_DECREASE of the rate).
+        If `callback` is given, it is called with a `Progress` tuple every ADAPT_INTERVAL moves
+        """
+        start_time = time.perf_counter()
+        best_energy, best = self.energy, self.packing.placements()
+        window_changes = self.sum_changes
+        while self.temperature > 0:
+            elapsed = time.perf_counter() - start_time
+            if (time_budget is not None and elapsed >= time_budget) or (max_iterations is not None and self.iterations >= max_iterations):
+                break
+            if self.iterations and self.iterations % ADAPT_INTERVAL == 0:
+                acceptance = (self.sum_changes - window_changes) / ADAPT_INTERVAL
+                window_changes = self.sum_changes
+                remaining = float('inf')
+                if time_budget is not None:
+                    remaining = (time_budget - elapsed) / (elapsed / self.iterations)
+                if max_iterations is not None:
+                    remaining = min(remaining, max_iterations - self.iterations)
+                self.temp_decr_rate = self.temperature / (max(remaining, 1) * (acceptance + REJECTED_DECREASE * (1 - acceptance)))
+                if callback is not None:
+                    callback(Progress(self.iterations, elapsed, self.temperature, acceptance, 1 - self.energy / 100000, 1 - best_energy / 100000))
+            self.step()
+            self.iterations += 1
+            if self.energy < best_energy:
+                best_energy, best = self.energy, self.packing.placements()
+        if best_energy < self.energy:  # the last packing is worse than the best one met
+            self.packing.bins = best.to_bins()
+            self.evaluator.reset(self.packing.bins)
+            self.energy = best_energy
+        self.best_fitness = 1 - self.energy / 100000
+
+    def start(self):
+        """scores the current bins and resets the counters of changes, it must be called before `step`, returns the fitness of the bins"""
+        self.evaluator = FitnessEvaluator(self.packing.bin_size, self.packing.coeffs, self.packing.bins)
+        self.energy = 100000 * (1 - self.evaluator.value())
+        self.sum_changes = 0
+        self.poss_changes = 0
+        return self.evaluator.value()
+
+    @stats.timed('sa move')
+    def step(self):
+        """makes one move at temperature `self.temperature`, keeps it or undoes it, then decreases the temperature"""
+        touched = self.make_a_swap_move()
+        if touched != 'error':
+            # only the two bins touched by the move are rescored
+            possible_new_energy = 100000 * (1 - self.evaluator.update(self.packing.bins, touched))
+            energy_diff = possible_new_energy - self.energy
+            if energy_diff < 0 or np.random.random() < np.exp(-energy_diff / self.temperature):
+                self.sum_changes += 1
+                stats.count('sa accepted')
+                if energy_diff >= 0:
+                    self.poss_changes += 1
+                    stats.count('sa accepted worse')
+                self.energy = possible_new_energy
+                self.temperature -= self.temp_decr_rate
             else:
-                temperature -= self.temp_decr_rate * 0.1
-        return sum_changes, poss_changes, init_fitness
+                stats.count('sa rejected')
+                self.undo_move()
+                self.evaluator.update(self.packing.bins, touched)  # move rejected, evaluator goes back to the restored bins
+                self.temperature -= self.temp_decr_rate * REJECTED_DECREASE
+        else:
+            stats.count('sa impossible move')
+            self.temperature -= self.temp_decr_rate * REJECTED_DECREASE
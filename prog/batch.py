@@ -0,0 +1,117 @@
+import json
+import os
+import signal
+import threading
+import time
+from multiprocessing import Pool
+
+from prog import stats
+
+IN_FLIGHT_PER_WORKER = 2  # jobs taken from the tasks of `run_batch` and not finished yet, per worker
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def raise_timeout(signum, frame):
+    raise JobTimeout()
+
+
+def run_job(task):
+    """Runs `job(argument)` in a worker process, with at most `timeout` seconds if it is not None (Unix only, cf signal.setitimer)
+    `job` returns (number of polygons, number of bins, time, fitness), see `prog.calc_instance`, optionally followed by a dict of other fields of the record.
+    Returns a dict describing the result of the job `name`, its 'status' is 'ok', 'timeout' or 'error'
+    If stats are collected in the worker (see `prog.stats.enable_stats`), the record has the 'profile' of the job
+    """
+    job, name, argument, timeout = task
+    record = {'filename': name}
+    if timeout is not None:
+        signal.signal(signal.SIGALRM, raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    if stats.STATS is not None:
+        stats.enable_stats()  # each job gets its own profile
+    start = time.perf_counter()
+    try:
+        count, bins, duration, fit, *extra = job(argument)
+        record.update(status='ok', count=count, bins=bins, time=duration, fitness=fit)
+        if extra:
+            record.update(extra[0])
+    except JobTimeout:
+        record.update(status='timeout', time=time.perf_counter() - start)
+    except Exception as e:  # one failing instance must not stop the batch
+        record.update(status='error', error=repr(e), time=time.perf_counter() - start)
+    finally:
+        if timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    if stats.STATS is not None:
+        record['profile'] = stats.STATS.to_dict()
+    return record
+
+
+def load_results(results_path):
+    """returns the records of the JSONL file `results_path` by filename (the last one wins), a truncated last line is ignored"""
+    results = {}
+    if not os.path.exists(results_path):
+        return results
+    with open(results_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:  # line being written when the previous run was stopped
+                continue
+            results[record['filename']] = record
+    return results
+
+
+def run_batch(job, tasks, results_path, workers=None, timeout=None, initializer=None, initargs=(), verbose=True):
+    """Runs `job(argument)` for every (name, argument) of `tasks` in a pool of `workers` processes (default: number of CPUs)
+    `tasks` can be a generator, it is consumed while the first jobs are running: at most IN_FLIGHT_PER_WORKER jobs per worker
+    are taken from it and not finished, so generation (and files written by it) is paced by the workers.
+    Each result is appended to the JSONL file `results_path` as soon as its job finishes, so a stopped batch loses nothing.
+    When restarted, jobs which already have an 'ok' result in `results_path` are skipped (failed ones are run again).
+    Returns the records of all `tasks` in the same order (jobs without any record are left out)
+    """
+    results = load_results(results_path)
+    names = []
+    skipped = 0
+    # the pool sends tasks from its own thread as fast as the generator yields them, this thread waits here instead
+    in_flight = threading.BoundedSemaphore(IN_FLIGHT_PER_WORKER * (workers or os.cpu_count()))
+
+    def todo():
+        nonlocal skipped
+        for name, argument in tasks:
+            names.append(name)
+            if results.get(name, {}).get('status') == 'ok':
+                skipped += 1
+            else:
+                in_flight.acquire()
+                yield job, name, argument, timeout
+
+    start = time.perf_counter()
+    finished, parts = 0, 0
+    with Pool(workers, initializer=initializer, initargs=initargs) as pool, open(results_path, 'a') as out:
+        for record in pool.imap_unordered(run_job, todo()):
+            in_flight.release()
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+            results[record['filename']] = record
+            finished += 1
+            parts += record.get('count', 0)
+            if verbose:
+                elapsed = time.perf_counter() - start
+                print('[{}] {}: {}, {:.3f} jobs/s, {:.1f} parts/s'.format(
+                    finished, record['filename'], record['status'], finished / elapsed, parts / elapsed))
+    if verbose and skipped:
+        print('Skipped (already done):', skipped)
+    return [results[name] for name in names if name in results]
+
+
+def write_summary(records, infofile_path):
+    """writes the results of successful jobs in the format of calc_info files: lists of polygons counts, bins used, times and fitnesses"""
+    records = [record for record in records if record['status'] == 'ok']
+    with open(infofile_path, 'w') as infofile:
+        print([record['count'] for record in records], file=infofile)
+        print([record['bins'] for record in records], file=infofile)
+        print([record['time'] for record in records], file=infofile)
+        print([record['fitness'] for record in records], file=infofile)
@@ -0,0 +1,150 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+from prog import input_data
+from prog.packing import Packing, clear_caches
+from prog.fitness import fitness
+
+# Benchmark of the nesting algorithms, run it with `python -m prog.benchmark` (see --help)
+# Every instance is nested by every algorithm, after a warm-up run (discarded) so numba compilation is not measured.
+# Results (wall time, bins used, fitness and peak memory of each run) are saved as JSON, and can be compared with a previous result file
+
+DIRECTORIES = ['input/classic/dir_greedy_descending', 'input/classic/dir_greedy_random', 'input/classic/dir_sa_random_500_1']
+ALGORITHMS = ['initial', 'greedy', 'simulated annealing']
+SA_PARAMETERS = [500.0, 1.0]  # initial temperature and decrease rate of simulated annealing, if the instance file doesn't give them
+SA_ITERATIONS = 200  # number of moves of simulated annealing, so its duration depends on the speed of moves only
+# figures of synthetic instances (like `prog.autogenerator_input`): rectangle 3 x 5, equilateral triangle of side 4, isosceles trapezium 6 / 3
+SYNTHETIC_FIGURES = [((0, 0), (0, 5.0), (3.0, 5.0), (3.0, 0)),
+                     ((0.0, 0.0), (4.0, 0.0), (2.0, 2.0 * math.tan(math.pi / 3))),
+                     ((0.0, 0.0), (6.0, 0.0), (4.5, 3.0), (1.5, 3.0))]
+SYNTHETIC_BIN_SIZE = (30.0, 40.0)
+WARM_UP_COUNT = 4  # count of the synthetic instance nested once by each algorithm before measuring, it is large enough to compute nfps
+
+
+def shipped_instances(directories, limit=None):
+    """yields (name, instance) for the classic input files of `directories`, the `limit` smallest counts of each directory"""
+    for directory in directories:
+        filenames = sorted((name for name in os.listdir(directory) if name.split('.')[0].isdigit()), key=lambda name: int(name.split('.')[0]))
+        for name in filenames[:limit]:
+            with open(directory + '/' + name) as f:
+                mode, *data = input_data(f.readlines())
+            if mode == 'classic_input':
+                yield directory + '/' + name, data
+
+
+def synthetic_instances(counts):
+    """yields (name, instance) for instances made of `count` copies of each figure of SYNTHETIC_FIGURES, for every count of `counts`"""
+    for count in counts:
+        polygons = {polygon: count for polygon in SYNTHETIC_FIGURES}
+        yield 'synthetic/' + str(count), (polygons, SYNTHETIC_BIN_SIZE, 'greedy', [], 'descending area')
+
+
+def run(instance, algo, seed, trace_memory=False):
+    """Nests `instance` with `algo`, returns (wall time, bins used, fitness, peak memory in bytes or None)"""
+    polygons, bin_size, file_algo, algo_extra, sort = instance
+    if algo == 'simulated annealing' and file_algo != algo:
+        algo_extra = SA_PARAMETERS
+    clear_caches()  # every run starts from the same state
+    random.seed(seed)
+    np.random.seed(seed)
+    if trace_memory:
+        tracemalloc.start()
+    time1 = time.perf_counter()
+    packing = Packing(bin_size, polygons)
+    packing.nest_all(False, algo, sort, algo_extra, max_iterations=SA_ITERATIONS if algo == 'simulated annealing' else None)
+    duration = time.perf_counter() - time1
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return duration, len(packing.bins), fitness(packing.bins, packing.bin_size, packing.coeffs), peak
+
+
+def run_benchmark(instances, algorithms, seed=0, memory=True, verbose=True):
+    """Returns the list of results of every (instance, algorithm)
+    Each algorithm first nests a small synthetic instance, this run is discarded as it includes numba compilation.
+    Peak memory is measured with tracemalloc in another run, so tracing doesn't slow down the timed run
+    """
+    results = []
+    for _, instance in synthetic_instances([WARM_UP_COUNT]):
+        for algo in algorithms:
+            run(instance, algo, seed)
+    for name, instance in instances:
+        for algo in algorithms:
+            duration, bins, fit, _ = run(instance, algo, seed)
+            peak = run(instance, algo, seed, trace_memory=True)[3] if memory else None
+            results.append({'instance': name, 'algo': algo, 'parts': sum(instance[0].values()),
+                            'time': duration, 'bins': bins, 'fitness': fit, 'peak_memory': peak})
+            if verbose:
+                print('{} [{}]: {:.3f} s, {} bins, fitness {:.6f}{}'.format(
+                    name, algo, duration, bins, fit, '' if peak is None else ', peak memory {:.1f} MB'.format(peak / 2 ** 20)))
+    return results
+
+
+def machine_info():
+    import numba
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'numba': numba.__version__, 'cpus': os.cpu_count()}
+
+
+def compare(results, baseline, time_threshold=0.2, quality_threshold=0.001, min_time=0.05):
+    """Returns the list of regressions of `results` compared to `baseline` (results of a previous benchmark), as strings:
+    time greater than the baseline time by more than `time_threshold` (relative, times under `min_time` seconds are ignored),
+    fitness lower than the baseline fitness by more than `quality_threshold`, or more bins used
+    """
+    previous = {(result['instance'], result['algo']): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = previous.get((result['instance'], result['algo']))
+        if base is None:
+            continue
+        label = '{} [{}]'.format(result['instance'], result['algo'])
+        if result['time'] > max(base['time'], min_time) * (1 + time_threshold):
+            regressions.append('{}: time {:.3f} s instead of {:.3f} s'.format(label, result['time'], base['time']))
+        if result['fitness'] < base['fitness'] - quality_threshold:
+            regressions.append('{}: fitness {:.6f} instead of {:.6f}'.format(label, result['fitness'], base['fitness']))
+        if result['bins'] > base['bins']:
+            regressions.append('{}: {} bins instead of {}'.format(label, result['bins'], base['bins']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the nesting algorithms on the shipped instances and on synthetic instances')
+    parser.add_argument('--dirs', nargs='*', default=DIRECTORIES)
+    parser.add_argument('--limit', default=5, type=int, help='number of instances (smallest counts first) of each directory')
+    parser.add_argument('--synthetic', nargs='*', default=[10, 20, 40], type=int, help='counts of each figure of synthetic instances')
+    parser.add_argument('--algos', nargs='*', default=ALGORITHMS, choices=ALGORITHMS)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--no-memory', action='store_const', const=True, help="don't measure peak memory (one run less per instance)")
+    parser.add_argument('-o', '--output', default='benchmark.json')
+    parser.add_argument('--baseline', default=None, help='results of a previous benchmark to compare with')
+    parser.add_argument('--time-threshold', default=0.2, type=float)
+    parser.add_argument('--quality-threshold', default=0.001, type=float)
+    namespace = parser.parse_args(sys.argv[1:])
+
+    instances = list(shipped_instances(namespace.dirs, namespace.limit)) + list(synthetic_instances(namespace.synthetic))
+    results = run_benchmark(instances, namespace.algos, namespace.seed, not namespace.no_memory)
+    with open(namespace.output, 'w') as f:
+        json.dump({'machine': machine_info(), 'seed': namespace.seed, 'results': results}, f, indent=1)
+    print('Results written to', namespace.output)
+    if namespace.baseline is not None:
+        with open(namespace.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, namespace.time_threshold, namespace.quality_threshold)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        print('Regressions:', len(regressions))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
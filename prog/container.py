@@ -0,0 +1,107 @@
+import copy
+
+from prog.geometry import polygon_area, polygon_size
+from prog import stats
+
+
+class Bin(list):
+    """Class representing a container (aka a bin): a list of tuples (initial polygon, transformed polygon, translation), see class Packing
+    It also keeps, for every polygon it has been queried with, the union of minkowski sums computed by `prog.nfp.find_nfp`,
+    and the polygons which had no valid position in it
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        # {polygon: (number of first polygons of the bin included in the union, union paths)}
+        # appending a polygon keeps unions valid (they are extended on the next query), any other change invalidates them
+        self.nfp_unions = {}
+        # polygons without any valid position in the bin: appending a polygon only takes free space, so they still don't fit after it
+        self.no_fit = set()
+        self.filled_area = sum(polygon_area(pg) for _, pg, _ in self)  # sum of the areas of polygons in the bin
+
+    def invalidate(self):
+        """drops all cached unions and rejected polygons and recomputes the filled area,
+        must be called whenever polygons are removed, replaced or reordered
+        """
+        self.nfp_unions = {}
+        self.no_fit = set()
+        self.filled_area = sum(polygon_area(pg) for _, pg, _ in self)
+
+    def may_fit(self, polygon, bin_size):
+        """Cheap necessary condition for `polygon` to fit in the bin, without any clipper work:
+        it had a valid position the last time it was queried in the bin (see `reject`), its bounding box fits in the bin
+        and its area fits in the free area of the bin
+        If it returns False, `prog.nfp.find_nfp` would not find any valid position, so it doesn't have to be called
+        """
+        if polygon in self.no_fit:
+            return False
+        width, height = polygon_size(polygon)
+        if width > bin_size[0] or height > bin_size[1]:
+            return False
+        return polygon_area(polygon) <= bin_size[0] * bin_size[1] - self.filled_area
+
+    def reject(self, polygon):
+        """records that `polygon` has no valid position in the bin (called by `prog.nfp.find_nfp` and `prog.nfp.find_best_nfp_pt`)"""
+        self.no_fit.add(polygon)
+
+    def append(self, item):
+        super().append(item)
+        self.filled_area += polygon_area(item[1])
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def pop(self, *args):
+        item = super().pop(*args)
+        self.invalidate()
+        return item
+
+    def remove(self, item):
+        super().remove(item)
+        self.invalidate()
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self.invalidate()
+
+    def clear(self):
+        super().clear()
+        self.invalidate()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.invalidate()
+
+    def reverse(self):
+        super().reverse()
+        self.invalidate()
+
+    def __setitem__(self, index, item):
+        super().__setitem__(index, item)
+        self.invalidate()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self.invalidate()
+
+    def __imul__(self, n):
+        super().__imul__(n)
+        self.invalidate()
+        return self
+
+    def __deepcopy__(self, memo):
+        stats.count('bin deepcopy')
+        # union paths are never modified in place, so the copy can share them
+        new_bin = Bin(copy.deepcopy(list(self), memo))
+        new_bin.nfp_unions = dict(self.nfp_unions)
+        new_bin.no_fit = set(self.no_fit)
+        return new_bin
+
+    def __reduce__(self):
+        # cached unions and rejected polygons are not pickled (e.g. when sent to worker processes), they are rebuilt on demand
+        return (Bin, (list(self), ))
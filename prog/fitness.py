@@ -1,7 +1,33 @@
+import math
+from functools import lru_cache
+import numpy as np
+from numba import njit, float64, int64
 from shapely.geometry import Polygon, MultiPolygon, GeometryCollection, LinearRing, MultiLineString, LineString, Point
 
+from prog.minkowski import signed_area, cross
+from prog.stats import timed
+
+RESUM_INTERVAL = 1000  # number of updates of `FitnessEvaluator` after which its totals are summed again from the cached scores
+FITNESS_BACKEND = 'shapely'  # 'shapely' (one shapely geometry per polygon) or 'numba' (packed arrays of vertices, see `packed_bin_stats`)
+
+
+def set_fitness_backend(backend):
+    """Selects the implementation of `fitness` and `FitnessEvaluator`, it can be used as initializer of worker processes"""
+    global FITNESS_BACKEND
+    if backend not in ('shapely', 'numba'):
+        raise ValueError("unknown fitness backend: " + str(backend))
+    FITNESS_BACKEND = backend
+
+
+def get_fitness_backend():
+    return FITNESS_BACKEND
+
+
+@timed('fitness')
 def fitness(bins, binsize, coeffs):
         """Packing fitness"""
+        if FITNESS_BACKEND == 'numba':
+            return FitnessEvaluator(binsize, coeffs, bins).value()
         fitness_A = (sum(bin_fitness_A(abin, binsize) for abin in bins[:-1]) + last_bin_fitness_A(bins[-1]))  / len(bins)
         # fitness_A = len(bins)
         fitness_B = sum(bin_fitness_B(abin) for abin in bins) / len(bins)
@@ -50,3 +76,166 @@ def bin_fitness_C(abin, bin_size):
 #         maxratio = binmax / remmax
 #         minratio = binmin / remmin
     return vertical * bin_size[0]
+
+
+def bin_stats(abin):
+    """Returns the values of a bin used by the fitness function:
+    (sum of polygons areas, convex hull of all polygons, area of this convex hull, envelope bounds of all polygons)
+    The convex hull is a shapely geometry or a counter-clockwise array of points, depending on `FITNESS_BACKEND`
+    """
+    if FITNESS_BACKEND == 'numba':
+        area, hull, bounds = packed_bin_stats(*pack_bin(abin))
+        return area, hull, abs(signed_area(hull)), tuple(bounds)
+    polygons = [Polygon(pg + translation) for _, pg, translation in abin]
+    union = GeometryCollection(polygons)
+    hull = union.convex_hull
+    return sum(pg.area for pg in polygons), hull, hull.area, union.bounds
+
+
+@lru_cache(maxsize=None)
+def polygon_array(polygon):
+    return np.array(polygon, dtype=np.float64)
+
+
+def pack_bin(abin):
+    """Returns the translated vertices of all polygons of `abin` as one contiguous array,
+    and the offsets of the polygons in this array (polygon k is vertices[offsets[k]:offsets[k + 1]])
+    """
+    offsets = np.zeros(len(abin) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(pg) for _, pg, _ in abin])
+    vertices = np.empty((offsets[-1], 2))
+    for k, (_, pg, translation) in enumerate(abin):
+        vertices[offsets[k]:offsets[k + 1]] = polygon_array(pg) + translation
+    return vertices, offsets
+
+
+@njit((float64[:, ::1], ), cache=True, nogil=True)
+def convex_hull(pts):
+    """Andrew's monotone chain: counter-clockwise convex hull of the points `pts`, without collinear vertices"""
+    order = np.argsort(pts[:, 1], kind='mergesort')
+    order = order[np.argsort(pts[order, 0], kind='mergesort')]  # sorted by x, then by y
+    hull = np.empty((2 * len(pts) + 1, 2))
+    count = 0
+    for i in order:  # lower hull
+        while count >= 2 and cross(hull[count - 2], hull[count - 1], pts[i]) <= 0:
+            count -= 1
+        hull[count] = pts[i]
+        count += 1
+    lower = count + 1
+    for k in range(len(order) - 2, -1, -1):  # upper hull
+        i = order[k]
+        while count >= lower and cross(hull[count - 2], hull[count - 1], pts[i]) <= 0:
+            count -= 1
+        hull[count] = pts[i]
+        count += 1
+    return hull[:max(count - 1, 1)]  # last point is the first one
+
+
+@njit((float64[:, ::1], int64[::1]), cache=True, nogil=True)
+def packed_bin_stats(vertices, offsets):
+    """Numba version of `bin_stats` over packed vertices (see `pack_bin`): returns (sum of polygons areas, convex hull, bounds array)"""
+    area_sum = 0.0
+    for k in range(len(offsets) - 1):
+        area_sum += abs(signed_area(vertices[offsets[k]:offsets[k + 1]]))
+    bounds = np.empty(4)
+    bounds[0], bounds[1] = vertices[:, 0].min(), vertices[:, 1].min()
+    bounds[2], bounds[3] = vertices[:, 0].max(), vertices[:, 1].max()
+    return area_sum, convex_hull(vertices), bounds
+
+
+class FitnessEvaluator:
+    """Packing fitness (see `fitness`) with cached scores of each bin
+    After a move, only the bins touched by the move are recomputed, and the total is updated in O(touched bins).
+    Every RESUM_INTERVAL updates, totals are summed again from the cached scores, so rounding errors of the updates don't pile up
+    """
+
+    def __init__(self, bin_size, coeffs, bins=()):
+        self.bin_size = bin_size
+        self.coeffs = coeffs
+        self.reset(bins)
+
+    @timed('fitness reset')
+    def reset(self, bins):
+        """recomputes the cached scores of all `bins`"""
+        self.stats = []  # one `bin_stats` tuple per bin
+        self.area_sum = 0  # sum of polygons areas over all bins
+        self.ratio_sum = 0  # sum over all bins of polygons area / convex hull area
+        self.updates = 0  # number of updates since the totals were last summed
+        self._refresh(bins)
+        self._resum()
+
+    @timed('fitness update')
+    def update(self, bins, touched=()):
+        """recomputes the cached scores of the bins with indices in `touched`, of the bins appended since the previous call
+        and forgets the bins removed from the end of `bins`, then returns the fitness of `bins`
+        """
+        self._refresh(bins, touched)
+        self.updates += 1
+        if self.updates >= RESUM_INTERVAL:
+            self._resum()
+        return self.value()
+
+    def value(self):
+        """fitness of the bins given to the last `update` call, same as `fitness(bins, bin_size, coeffs)`"""
+        return self._total(self.area_sum, self.ratio_sum, self.stats[-1])
+
+    @timed('fitness propose')
+    def propose(self, idx, polygon, translation):
+        """fitness of the bins given to the last `update` call if `polygon` translated by `translation` was appended to the bin `idx`
+        Cached scores are not changed
+        """
+        area, hull, hull_area, (minx, miny, maxx, maxy) = self.stats[idx]
+        if FITNESS_BACKEND == 'numba':
+            new_pts = polygon_array(polygon) + translation
+            new_area = abs(signed_area(new_pts))
+            new_hull = convex_hull(np.concatenate((hull, new_pts)))
+            new_hull_area = abs(signed_area(new_hull))
+            new_minx, new_miny = new_pts.min(axis=0)
+            new_maxx, new_maxy = new_pts.max(axis=0)
+        else:
+            new_polygon = Polygon(polygon + translation)
+            new_area = new_polygon.area
+            new_hull = GeometryCollection([hull, new_polygon]).convex_hull
+            new_hull_area = new_hull.area
+            new_minx, new_miny, new_maxx, new_maxy = new_polygon.bounds
+        new_stats = (area + new_area, new_hull, new_hull_area,
+                     (min(minx, new_minx), min(miny, new_miny), max(maxx, new_maxx), max(maxy, new_maxy)))
+        area_sum = self.area_sum - area + new_stats[0]
+        ratio_sum = self.ratio_sum - area / hull_area + new_stats[0] / new_hull_area
+        return self._total(area_sum, ratio_sum, new_stats if idx == len(self.stats) - 1 else self.stats[-1])
+
+    def _total(self, area_sum, ratio_sum, last_stats):
+        n_bins = len(self.stats)
+        last_area, _, _, (minx, miny, maxx, maxy) = last_stats
+        fitness_A = (n_bins - (area_sum - last_area) / (self.bin_size[0] * self.bin_size[1])
+                     - last_area / ((maxx - minx) * (maxy - miny))) / n_bins
+        fitness_B = (n_bins - ratio_sum) / n_bins
+        fitness_C = 0
+        A, B, C = self.coeffs
+        return 1 - (A * fitness_A + B * fitness_B + C * fitness_C)
+
+    def _refresh(self, bins, touched=()):
+        while len(self.stats) > len(bins):
+            self._forget(self.stats.pop())
+        for idx in set(touched):
+            if idx < len(self.stats):
+                self._forget(self.stats[idx])
+                self.stats[idx] = self._remember(bin_stats(bins[idx]))
+        for abin in bins[len(self.stats):]:
+            self.stats.append(self._remember(bin_stats(abin)))
+
+    def _resum(self):
+        self.area_sum = math.fsum(stats[0] for stats in self.stats)
+        self.ratio_sum = math.fsum(stats[0] / stats[2] for stats in self.stats)
+        self.updates = 0
+
+    def _remember(self, stats):
+        area, _, hull_area, _ = stats
+        self.area_sum += area
+        self.ratio_sum += area / hull_area
+        return stats
+
+    def _forget(self, stats):
+        area, _, hull_area, _ = stats
+        self.area_sum -= area
+        self.ratio_sum -= area / hull_area
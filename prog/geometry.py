@@ -0,0 +1,58 @@
+from functools import lru_cache
+import numpy as np
+
+# clipper works with integers, so all coordinates are converted to fixed point numbers once, when an instance is loaded:
+# they are multiplied by SCALE and rounded to integers, then converted back to floats only to output the result
+# with coordinates up to 10**6 (bins of 100 units), products of coordinates stay exact in float64
+SCALE = 10000
+
+
+def to_fixed(value):
+    return int(round(value * SCALE))
+
+
+def to_float(value):
+    return value / SCALE
+
+
+def scale_polygon(polygon):
+    """returns `polygon` with fixed point integer coordinates"""
+    return tuple([(to_fixed(x), to_fixed(y)) for x, y in polygon])
+
+
+def unscale_polygon(polygon):
+    """returns fixed point `polygon` with float coordinates"""
+    return tuple([(to_float(x), to_float(y)) for x, y in polygon])
+
+
+def scale_translation(translation):
+    return np.array([to_fixed(translation[0]), to_fixed(translation[1])])
+
+
+def unscale_translation(translation):
+    return np.array(translation) / SCALE
+
+
+@lru_cache(maxsize=None)
+def polygon_area(polygon):
+    """area of `polygon` (tuple of points), cached as polygons are reused by all bins"""
+    area = 0
+    for (x1, y1), (x2, y2) in zip(polygon, polygon[1:] + polygon[:1]):
+        area += x1 * y2 - x2 * y1
+    return abs(area) / 2
+
+
+@lru_cache(maxsize=None)
+def polygon_bounds(polygon):
+    """bounding box (minx, miny, maxx, maxy) of `polygon`"""
+    xs = [x for x, _ in polygon]
+    ys = [y for _, y in polygon]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+@lru_cache(maxsize=None)
+def polygon_size(polygon):
+    """size of the bounding box of `polygon` along x and y"""
+    xs = [x for x, _ in polygon]
+    ys = [y for _, y in polygon]
+    return max(xs) - min(xs), max(ys) - min(ys)
@@ -0,0 +1,168 @@
+import numpy as np
+import pyclipper
+from numba import njit, float64
+
+
+def minkowski_sum(pg1, pg2):
+    """Minkowski sum of two polygons given as arrays of points (first point and last point not equal), in any orientation
+    Returns the outer boundary of the sum as a counter-clockwise array of points.
+    Convex polygons (all polygons made by the autogenerator) are summed in linear time by merging their edges,
+    other polygons are decomposed into triangles whose sums are merged with clipper.
+    If a polygon can't be triangulated (it is not simple), the sum is computed by `clipper_minkowski_sum`
+    """
+    pg1 = counterclockwise(np.asarray(pg1, dtype=np.float64))
+    pg2 = counterclockwise(np.asarray(pg2, dtype=np.float64))
+    if is_convex(pg1) and is_convex(pg2):
+        return convex_minkowski_sum(pg1, pg2)
+
+    try:
+        pieces1 = [pg1] if is_convex(pg1) else [pg1[triangle] for triangle in triangulate(pg1)]
+        pieces2 = [pg2] if is_convex(pg2) else [pg2[triangle] for triangle in triangulate(pg2)]
+    except ValueError:  # a partial triangulation would give a sum too small, so nfps allowing overlaps
+        return clipper_minkowski_sum(pg1, pg2)
+    sums = [convex_minkowski_sum(piece1, piece2) for piece1 in pieces1 for piece2 in pieces2]
+    # clipper works with integers, coordinates are scaled so the union doesn't lose precision
+    return outer_boundary(pyclipper.scale_to_clipper(sums))
+
+
+def clipper_minkowski_sum(pg1, pg2):
+    """Minkowski sum of any two polygons (arrays of points) computed by clipper: `pg1` swept along the edges of `pg2`,
+    united with `pg2` translated by a vertice of `pg1`, which fills the inside of the sweep. Returns the outer boundary, counter-clockwise
+    """
+    path1 = pyclipper.scale_to_clipper(pg1.tolist())
+    path2 = pyclipper.scale_to_clipper(pg2.tolist())
+    paths = pyclipper.MinkowskiSum(path1, path2, True)
+    paths.append(pyclipper.scale_to_clipper((pg2 + pg1[0]).tolist()))
+    return outer_boundary(paths)
+
+
+def outer_boundary(paths):
+    """outer boundary of the union of the (scaled to clipper) `paths`, as a counter-clockwise array of points"""
+    pc = pyclipper.Pyclipper()
+    pc.AddPaths(paths, pyclipper.PT_SUBJECT, True)
+    union = pc.Execute(pyclipper.CT_UNION, pyclipper.PFT_NONZERO, pyclipper.PFT_NONZERO)
+    # sum of two connected polygons is connected, its outer boundary is the path with the largest area (other paths are holes)
+    outer = max(union, key=pyclipper.Area)
+    return counterclockwise(np.array(pyclipper.scale_from_clipper(outer), dtype=np.float64))
+
+
+def counterclockwise(pg):
+    """returns `pg` with counter-clockwise orientation"""
+    return pg if signed_area(pg) >= 0 else pg[::-1].copy()
+
+
+@njit(cache=True, nogil=True)
+def signed_area(pg):
+    """Shoelace formula, the area is positive if `pg` has counter-clockwise orientation"""
+    area = 0.0
+    n = len(pg)
+    for i in range(n):
+        j = (i + 1) % n
+        area += pg[i, 0] * pg[j, 1] - pg[j, 0] * pg[i, 1]
+    return area / 2
+
+
+@njit(cache=True, nogil=True)
+def cross(o, a, b):
+    """z coordinate of the cross product of vectors oa and ob"""
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+
+@njit(cache=True, nogil=True)
+def is_convex(pg):
+    """Checks that the counter-clockwise polygon `pg` doesn't turn clockwise at any vertice (collinear vertices are allowed)"""
+    n = len(pg)
+    for i in range(n):
+        if cross(pg[(i - 1) % n], pg[i], pg[(i + 1) % n]) < 0:
+            return False
+    return True
+
+
+@njit(cache=True, nogil=True)
+def lowest_vertice(pg):
+    best = 0
+    for i in range(1, len(pg)):
+        if pg[i, 1] < pg[best, 1] or (pg[i, 1] == pg[best, 1] and pg[i, 0] < pg[best, 0]):
+            best = i
+    return best
+
+
+@njit(cache=True, nogil=True)
+def remove_collinear(pg):
+    """removes repeated vertices and vertices lying on the segment between their neighbours"""
+    keep = np.ones(len(pg), dtype=np.bool_)
+    n = len(pg)
+    for i in range(n):
+        if (pg[i, 0] == pg[(i + 1) % n, 0] and pg[i, 1] == pg[(i + 1) % n, 1]) or cross(pg[(i - 1) % n], pg[i], pg[(i + 1) % n]) == 0:
+            keep[i] = False
+    return pg[keep]
+
+
+@njit((float64[:, ::1], float64[:, ::1]), cache=True, nogil=True)
+def convex_minkowski_sum(pg1, pg2):
+    """Minkowski sum of two counter-clockwise convex polygons in O(n + m)
+    Both polygons start from their lowest (then leftmost) vertice, edges of the sum are the edges of both polygons sorted by polar angle,
+    so the two sequences of edges are merged. Parallel edges are merged together and collinear vertices are removed
+    """
+    start1, start2 = lowest_vertice(pg1), lowest_vertice(pg2)
+    pg1 = np.concatenate((pg1[start1:], pg1[:start1]))
+    pg2 = np.concatenate((pg2[start2:], pg2[:start2]))
+    n, m = len(pg1), len(pg2)
+    result = np.empty((n + m, 2))
+    count = 0
+    i, j = 0, 0
+    while i < n or j < m:
+        result[count] = pg1[i % n] + pg2[j % m]
+        count += 1
+        edge1 = pg1[(i + 1) % n] - pg1[i % n]
+        edge2 = pg2[(j + 1) % m] - pg2[j % m]
+        turn = edge1[0] * edge2[1] - edge1[1] * edge2[0]
+        if i == n:
+            j += 1
+        elif j == m:
+            i += 1
+        else:
+            if turn >= 0:
+                i += 1
+            if turn <= 0:
+                j += 1
+    return remove_collinear(result[:count])
+
+
+@njit((float64[:, ::1], ), cache=True, nogil=True)
+def triangulate(pg):
+    """Ear clipping triangulation of the counter-clockwise simple polygon `pg`, returns an array of vertice indices (one row per triangle)
+    Raises ValueError if there is no ear left before the end (the polygon is not simple), a partial triangulation is never returned
+    """
+    remaining = [i for i in range(len(pg))]
+    triangles = np.empty((max(len(pg) - 2, 0), 3), dtype=np.int64)
+    count = 0
+    while len(remaining) > 3:
+        m = len(remaining)
+        found = False
+        for k in range(m):
+            a, b, c = remaining[(k - 1) % m], remaining[k], remaining[(k + 1) % m]
+            turn = cross(pg[a], pg[b], pg[c])
+            if turn == 0:  # degenerate vertice, it doesn't add any area
+                remaining.pop(k)
+                found = True
+                break
+            if turn < 0:  # reflex vertice, not an ear
+                continue
+            is_ear = True
+            for v in remaining:
+                if v != a and v != b and v != c and cross(pg[a], pg[b], pg[v]) >= 0 and cross(pg[b], pg[c], pg[v]) >= 0 and cross(pg[c], pg[a], pg[v]) >= 0:
+                    is_ear = False
+                    break
+            if is_ear:
+                triangles[count, 0], triangles[count, 1], triangles[count, 2] = a, b, c
+                count += 1
+                remaining.pop(k)
+                found = True
+                break
+        if not found:
+            raise ValueError('no ear found, the polygon is not simple')
+    if len(remaining) == 3:
+        triangles[count, 0], triangles[count, 1], triangles[count, 2] = remaining[0], remaining[1], remaining[2]
+        count += 1
+    return triangles[:count]
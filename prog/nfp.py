@@ -1,67 +1,188 @@
-import skgeom as sg
 import numpy as np
 import pyclipper
-from numba import njit, jit, literal_unroll
+from numba import njit, jit, literal_unroll, float64
 import math
-from pydantic import BaseModel
 import random
 import itertools
-from shapely.geometry import Polygon, MultiPolygon, GeometryCollection, LinearRing, MultiLineString, LineString, Point
 import copy
+import os
+
+from prog.minkowski import minkowski_sum as native_minkowski_sum
+from prog.nfp_store import NfpStore, canonical_key
+from prog.geometry import polygon_size, polygon_bounds
+from prog import stats
 
 SINGLE_NFPS = {}  # do not forget to reset cache before any nesting !
+MINKOWSKI_BACKEND = 'native'  # 'native' (prog.minkowski) or 'skgeom' (scikit-geometry)
+VALID_PTS_TOLERANCE = 1e-9  # maximal distance between a valid point and the nfp, see `get_valid_pts`
+NFP_STORE_PATH = None  # SQLite file used as persistent cache of minkowski sums, see `set_nfp_store`
+nfp_store = None
+# position chosen among the valid positions of a polygon by `find_best_nfp_pt`:
+# 'bottom left' (lowest, then leftmost), 'min bbox growth' (smallest envelope of the bin with the polygon) or 'max contact' (most edges touched)
+PLACEMENT_POLICIES = ('bottom left', 'min bbox growth', 'max contact')
+PLACEMENT_POLICY = 'bottom left'
+
+
+def set_placement_policy(policy):
+    """Selects the default policy of `find_best_nfp_pt`, it can be used as initializer of worker processes"""
+    global PLACEMENT_POLICY
+    if policy not in PLACEMENT_POLICIES:
+        raise ValueError("unknown placement policy: " + str(policy))
+    PLACEMENT_POLICY = policy
+
 
+def get_placement_policy():
+    return PLACEMENT_POLICY
 
-def select_best_nfp_pt(pts):
-    """Return one point among all input points `pts`.
-    Input points `pts` are the valid positions to  fit a new polygon in an existing container with other polygons
-    It selects the point which minimizes the vertical position (so polygon are stacked at the bottom of the container)
+
+def set_nfp_store(path):
+    """Makes `get_minkowski_sum` look for minkowski sums in the SQLite file `path` and save new ones in it (None disables the persistent cache)
+    It can be used as initializer of worker processes, all processes sharing the same file
     """
-    pts = np.array(pts)
-    ix = np.argmin(pts[:, 1])
-    return pts[ix]
+    global NFP_STORE_PATH, nfp_store
+    NFP_STORE_PATH = path
+    nfp_store = None
+
+
+def get_nfp_store():
+    """returns the `NfpStore` of the current process, or None if there is no persistent cache"""
+    global nfp_store
+    if NFP_STORE_PATH is None:
+        return None
+    if nfp_store is None or nfp_store.pid != os.getpid():  # a forked process must open its own connection
+        nfp_store = NfpStore(NFP_STORE_PATH)
+    return nfp_store
 
 
+@stats.timed('nfp query')
 def find_nfp(abin, bin_size, polygon):
     """Given an existing container (defined by `abin` and `bin_size`), returns all the valid positions to fit the new `polygon` into this container"""
+    clipped = get_clipped_nfp(abin, bin_size, polygon)
+    if clipped is None:
+        reject(abin, polygon)
+        return np.array([])
+    nfp_edges, candidates, _ = clipped
+    with stats.timer('nfp valid points'):
+        valid_pts = candidates[points_on_edges(nfp_edges, candidates, VALID_PTS_TOLERANCE)]
+    if not len(valid_pts):
+        reject(abin, polygon)
+    return valid_pts  # finally we return all the valid positions to fit the new polygon into the existing container
 
-    # list of minkowski sums between existing polygon and the new polygon, translated by the respective positions of existing polygon
-    paths = [get_minkowski_sum(polygon_, polygon, translation) 
-             for _, polygon_, translation in abin]
-    
-    # make a union of all minkowski sums, cf clipper library http://www.angusj.com/delphi/clipper.php
-    pc = pyclipper.Pyclipper()
-    pc.AddPaths(paths, pyclipper.PT_SUBJECT, True)
-    nfps = pc.Execute(pyclipper.CT_UNION, pyclipper.PFT_POSITIVE, pyclipper.PFT_POSITIVE)
+
+@stats.timed('nfp best point query')
+def find_best_nfp_pt(abin, bin_size, polygon, policy=None):
+    """Same query as `find_nfp`, but returns only the best valid position according to `policy` (default: PLACEMENT_POLICY), or None
+    Candidate points are scored at once, then tested in order of score (ties: lowest then leftmost), so the query stops at the first valid one.
+    'max contact' counts the edges through every candidate, so all of them are tested
+    """
+    policy = PLACEMENT_POLICY if policy is None else policy
+    clipped = get_clipped_nfp(abin, bin_size, polygon)
+    if clipped is None:
+        reject(abin, polygon)
+        return None
+    nfp_edges, candidates, bin_pts = clipped
+    x, y = candidates[:, 0], candidates[:, 1]
+    with stats.timer('nfp best point'):
+        if policy == 'bottom left':
+            best = first_point_on_edges(nfp_edges, candidates, np.lexsort((x, y)), VALID_PTS_TOLERANCE)
+        elif policy == 'min bbox growth':
+            minx, miny, maxx, maxy = bin_bounds(abin)
+            pminx, pminy, pmaxx, pmaxy = polygon_bounds(polygon)
+            envelope = ((np.maximum(maxx, x + pmaxx) - np.minimum(minx, x + pminx))
+                        * (np.maximum(maxy, y + pmaxy) - np.minimum(miny, y + pminy)))
+            best = first_point_on_edges(nfp_edges, candidates, np.lexsort((x, y, envelope)), VALID_PTS_TOLERANCE)
+        elif policy == 'max contact':
+            # contacts are the edges of the nfps through the point (an nfp vertex counts once, see `edge_counts`) and the container walls touched
+            edges = edge_counts(nfp_edges, candidates, VALID_PTS_TOLERANCE, False)
+            contacts = edges + (x == bin_pts[0][0]) + (y == bin_pts[0][1]) + (x == bin_pts[2][0]) + (y == bin_pts[2][1])
+            valid = np.flatnonzero(edges)
+            best = valid[np.lexsort((x[valid], y[valid], -contacts[valid]))[0]] if len(valid) else -1
+        else:
+            raise ValueError("unknown placement policy: " + str(policy))
+    if best < 0:
+        reject(abin, polygon)
+        return None
+    return candidates[best]
+
+
+def reject(abin, polygon):
+    """`polygon` has no valid position in `abin`, a `Bin` keeps it so that it is not queried again (see `Bin.may_fit`)"""
+    if hasattr(abin, 'reject'):  # plain lists keep nothing
+        abin.reject(polygon)
+
+
+def get_clipped_nfp(abin, bin_size, polygon):
+    """Returns (edges of the nfps, candidate positions, clipping rectangle) of `polygon` in the container `abin`, or None if nothing fits
+    Candidates are the vertices of the nfps clipped by the container, the valid positions are the candidates on the edges of the nfps
+    """
+    nfps = get_nfp_union(abin, polygon)
     # nfp means non-fitting polygon, with an 's' because it can be composed of several separated polygons
     # all points belonging to the nfps (so a vertice or on any edge) are valid positions to place the new polygon
     
-    valid_pts = []
-    for nfp in nfps:
-        # so far, container edges were not taken into account to compute the nfp
-        # the next step clips the nfp in order to keep only the part which fits inside the container
+    if not nfps:
+        return None
+
+    # so far, container edges were not taken into account to compute the nfp
+    # the next step clips all the nfps at once in order to keep only the part which fits inside the container
+    # (coordinates are fixed point integers, cf prog.geometry, so clipper doesn't lose precision)
+    with stats.timer('nfp clipping limits'):
         bin_pts = get_clipping_limits(bin_size, polygon)
-        pc = pyclipper.Pyclipper()
-        pc.AddPath(bin_pts, pyclipper.PT_CLIP, True)
-        pc.AddPaths([nfp], pyclipper.PT_SUBJECT, True)
+    pc = pyclipper.Pyclipper()
+    pc.AddPath(bin_pts, pyclipper.PT_CLIP, True)
+    pc.AddPaths(nfps, pyclipper.PT_SUBJECT, True)
+    with stats.timer('clipper intersection'):
         nfp_clip = pc.Execute(pyclipper.CT_INTERSECTION, pyclipper.PFT_NONZERO, pyclipper.PFT_NONZERO)
+    if not nfp_clip:
+        return None
+
+    # the previous step creates new points, like intersection of nfp edges with container edges
+    # some of these points are not valid position, the clipped nfps are compared to the original nfps to keep only valid points
+    with stats.timer('nfp edges'):
+        nfp_edges = np.concatenate([polygon_edges(np.array(nfp)) for nfp in nfps])
+        nfp_clip_flat = np.concatenate([np.array(path) for path in nfp_clip])
+    return nfp_edges, nfp_clip_flat, bin_pts
+
+
+def bin_bounds(abin):
+    """envelope (minx, miny, maxx, maxy) of all polygons of `abin`"""
+    minx, miny, maxx, maxy = math.inf, math.inf, -math.inf, -math.inf
+    for _, pg, translation in abin:
+        pminx, pminy, pmaxx, pmaxy = polygon_bounds(pg)
+        minx, miny = min(minx, pminx + translation[0]), min(miny, pminy + translation[1])
+        maxx, maxy = max(maxx, pmaxx + translation[0]), max(maxy, pmaxy + translation[1])
+    return minx, miny, maxx, maxy
 
-        # the previous step creates new points, like intersection of nfp edges with container edges
-        # some of these points are not valid position, we compare the original nfp and the clipped nfp the remove keep only valid points
-        nfp_flat = np.array(nfp)
-#         print(nfp_flat)
-#         print('/////////////////////')
-#         print(nfp_clip)
-        if nfp_clip:
-            nfp_clip_flat = np.array(nfp_clip[0])
-        else:
-            continue
-#         print('/////////////////////')
-#         print(nfp_clip_flat)
-#         print('#####################')
-        valid_pts.append(get_valid_pts(nfp_flat, nfp_clip_flat))
-    returning_valid_pts = np.concatenate(valid_pts) if valid_pts else np.array([])
-    return returning_valid_pts  # finally we return all the valid positions to fit the new polygon into the existing container
+
+def get_nfp_union(abin, polygon):
+    """Returns the union of the minkowski sums between the new `polygon` and every polygon of `abin`
+    If `abin` is a `Bin` (see prog.container), the union is cached in it for this `polygon`,
+    so only the minkowski sums of polygons appended since the previous query have to be added to the union
+    """
+    cached_unions = getattr(abin, 'nfp_unions', None)
+    if cached_unions is None:  # plain list, nothing to reuse
+        count, union = 0, []
+    else:
+        count, union = cached_unions.get(polygon, (0, []))
+    if count == len(abin):
+        stats.count('nfp union cache hit')
+        return union
+
+    # list of minkowski sums between existing polygon and the new polygon, translated by the respective positions of existing polygon
+    paths = [get_minkowski_sum(polygon_, polygon, translation)
+             for _, polygon_, translation in abin[count:]]
+
+    # make a union of all minkowski sums, cf clipper library http://www.angusj.com/delphi/clipper.php
+    # the previous union (outer paths are positive, holes are negative) is added as is, so the positive fill rule keeps it unchanged
+    with stats.timer('clipper union'):
+        pc = pyclipper.Pyclipper()
+        if union:
+            pc.AddPaths(union, pyclipper.PT_SUBJECT, True)
+        pc.AddPaths(paths, pyclipper.PT_SUBJECT, True)
+        union = pc.Execute(pyclipper.CT_UNION, pyclipper.PFT_POSITIVE, pyclipper.PFT_POSITIVE)
+
+    if cached_unions is not None:
+        cached_unions[polygon] = (len(abin), union)
+    return union
 
 def get_minkowski_sum(pg1: tuple, pg2: tuple, translation):
     """Minkowski sum is an operation between two polygons. 
@@ -74,89 +195,152 @@ def get_minkowski_sum(pg1: tuple, pg2: tuple, translation):
     """
     global SINGLE_NFPS  # used as cache
     
-    minkowski_sum = SINGLE_NFPS.get(hash((pg1, pg2)))
-    if minkowski_sum is None:
-        # if cache not available, compute minkowski sum
-        skpg1 = sg.Polygon(pg1)
-        if skpg1.orientation() == -1:  # check that polygon has the right orientation
-            skpg1.reverse_orientation()
-
-        skpg2 = sg.Polygon(-1 * np.array(pg2))
-        if skpg2.orientation() == -1:
-            skpg2.reverse_orientation()
-
-        # cf library scikit-geom https://scikit-geometry.github.io/scikit-geometry/polygon.html#Minkowski-Sum-of-2-Polygons
-        minkowski_sum = sg.minkowski.minkowski_sum(skpg1, skpg2).outer_boundary().coords
-        SINGLE_NFPS[hash((pg1, pg2))] = minkowski_sum
+    # keyed by the polygons themselves: unlike their `hash()`, two different pairs can't share an entry
+    minkowski_sum = SINGLE_NFPS.get((pg1, pg2))
+    if minkowski_sum is not None:
+        stats.count('minkowski cache hit')
+    else:
+        # if cache not available, look for the minkowski sum in the persistent cache or compute it
+        store = get_nfp_store()
+        if store is not None:
+            key = canonical_key(MINKOWSKI_BACKEND, pg1, pg2)
+            minkowski_sum = store.get(key)
+            stats.count('minkowski store ' + ('miss' if minkowski_sum is None else 'hit'))
+        if minkowski_sum is None:
+            with stats.timer('minkowski cache miss'):
+                if MINKOWSKI_BACKEND == 'native':
+                    minkowski_sum = native_minkowski_sum(pg1, -1 * np.array(pg2, dtype=np.float64))
+                else:
+                    minkowski_sum = get_skgeom_minkowski_sum(pg1, pg2)
+                minkowski_sum = np.rint(minkowski_sum)  # polygons have fixed point coordinates, so does their sum
+            if store is not None:
+                store.put(key, minkowski_sum)
+        SINGLE_NFPS[(pg1, pg2)] = minkowski_sum
     return vec_sum(minkowski_sum, translation)
 
-@njit()
+
+def get_skgeom_minkowski_sum(pg1: tuple, pg2: tuple):
+    """Reference implementation of `get_minkowski_sum` (without translation and cache) using scikit-geometry"""
+    try:  # imported on first use only, scikit-geometry can only be installed with conda, it is an optional reference backend
+        import skgeom as sg
+    except ImportError:
+        raise ImportError("scikit-geometry is required by the 'skgeom' minkowski backend")
+    skpg1 = sg.Polygon(pg1)
+    if skpg1.orientation() == -1:  # check that polygon has the right orientation
+        skpg1.reverse_orientation()
+
+    skpg2 = sg.Polygon(-1 * np.array(pg2))
+    if skpg2.orientation() == -1:
+        skpg2.reverse_orientation()
+
+    # cf library scikit-geom https://scikit-geometry.github.io/scikit-geometry/polygon.html#Minkowski-Sum-of-2-Polygons
+    return sg.minkowski.minkowski_sum(skpg1, skpg2).outer_boundary().coords
+
+
+@njit(cache=True, nogil=True)
 def vec_sum(array1, array2):
     """Sum of vectors, accelerated with numba"""
     return array1 + array2
 
-@njit(cache=True)
 def get_clipping_limits(bin_size, polygon):
     """Returns a rectangle corresponding to the container but offseted (toward the inside) with polygon delta along x and y 
     Geometrically, this rectangle corresponds to the most extreme positions of the polygon when moving the polygon along the edge of the container without intersecting it
     """
-    array = np.array(polygon)
-    x = np.max(array[:, 0]) - np.min(array[:, 0])
-    y = np.max(array[:, 1]) - np.min(array[:, 1])
+    # the size of the polygon is cached, and the kernel only takes floats, so it is compiled once (not once per type of polygon tuple)
+    x, y = polygon_size(polygon)
+    return clipping_rectangle(float(bin_size[0] - x), float(bin_size[1] - y))
+
+@njit((float64, float64), cache=True, nogil=True)
+def clipping_rectangle(x, y):
+    """rectangle from (0, 0) to (x, y)"""
     return np.array([
         [0.0, 0.0],
-        [float(bin_size[0] - x), 0.0],
-        [float(bin_size[0] - x), float(bin_size[1] - y)],
-        [0.0, float(bin_size[1] - y)]
+        [x, 0.0],
+        [x, y],
+        [0.0, y]
     ])
 
-@njit()
-def get_valid_pts(pg, pg_to_test):
+@njit(cache=True, nogil=True)
+def get_valid_pts(pg, pg_to_test, tolerance):
     """Given two arrays `pg` and `pg_to_test` describing polygons, returns all vertices of `pg_to_test` which are intersecting with `pg`
-    The main idea of this function is to use cross and dot products between vectors to understand which points of `pg_to_test` also belong to an edge or a vertice of `pg`
+    (so which belong to an edge or a vertice of `pg`, up to a distance `tolerance`)
     This function is Numba compatible
     """
-    pg_ = np.vstack((pg[-1:], pg[:-1]))
-    vectors = pg_ - pg  # defines `pg` as a array of vectors instead of an array of points
-    
-    # numpy `np.tile` function is not compatible with numba, but this next step is an equivalent, cf non numba version below
-    vectors_tiled = vectors
-    for _ in range(len(pg_to_test) - 1):  
-        vectors_tiled = np.vstack((vectors_tiled, vectors))
-    vectors_tiled = vectors_tiled.reshape(len(pg_to_test), len(pg), 2)
-    
-#     # NON numba version
-#     vectors_tiled = np.tile(vectors, (len(pg_to_test), 1, 1))
-
-
-    # same here, numba doesn't allow `axis` argument in `np.repeat` function
-    pg_to_test_repeated = pg_to_test
-    for _ in range(len(pg) - 1):
-        pg_to_test_repeated = np.hstack((pg_to_test_repeated, pg_to_test))
-        
-    pg_tiled = pg
-    for _ in range(len(pg_to_test) - 1):
-        pg_tiled = np.vstack((pg_tiled, pg))
-        
-    # `vectors_to_test` represents all possible vectors created with a vertice of `pg` and a vertice of `pg_to_test`
-    vectors_to_test = (pg_to_test_repeated.reshape(-1, 2) - pg_tiled).reshape(vectors_tiled.shape)
-    
-#     # non numba version
-#     vectors_to_test = (
-#         np.repeat(pg_to_test, len(pg), axis=0) - np.tile(pg, (len(pg_to_test), 1))
-#     ).reshape(vectors_tiled.shape)
-    
-    # `vectors_tiled` represented `pg` as vectors, repeated n times, n being the length of `pg_to_test`
-    # using cross product and dot product, we can now understand which points from `pg_to_test` also belongs to `pg`
-    cross_product = vectors_tiled[:,:,0] * vectors_to_test[:,:,1] - vectors_tiled[:,:,1] * vectors_to_test[:,:,0]
-    dot_product = vectors_tiled[:,:,0] * vectors_to_test[:,:,0] + vectors_tiled[:,:,1] * vectors_to_test[:,:,1]
-    valid_pts = pg_to_test[np_any_axis1((cross_product == 0) & (dot_product > 0) & (dot_product <= np.sum(vectors ** 2, axis=1)))]
-    return valid_pts
-
-@njit()
-def np_any_axis1(x):
-    """Numba compatible version of np.any(x, axis=1)."""
-    out = np.zeros(x.shape[0], dtype=np.bool8)
-    for i in range(x.shape[1]):
-        out = np.logical_or(out, x[:, i])
-    return out
+    return pg_to_test[points_on_edges(polygon_edges(pg), pg_to_test, tolerance)]
+
+@njit(cache=True, nogil=True)
+def polygon_edges(pg):
+    """Returns the edges of the closed polygon `pg` as an array of rows (x1, y1, x2, y2), each vertice is linked to the previous one"""
+    edges = np.empty((len(pg), 4))
+    for i in range(len(pg)):
+        edges[i, 0], edges[i, 1] = pg[i, 0], pg[i, 1]
+        edges[i, 2], edges[i, 3] = pg[i - 1, 0], pg[i - 1, 1]
+    return edges
+
+@njit(cache=True, nogil=True)
+def points_on_edges(edges, pts, tolerance):
+    """Returns a boolean mask of the points `pts` lying on at least one of the `edges` (rows (x1, y1, x2, y2)), up to a distance `tolerance`"""
+    return edge_counts(edges, pts, tolerance, True) > 0
+
+@njit(cache=True, nogil=True)
+def first_point_on_edges(edges, pts, order, tolerance):
+    """Returns the first index of `order` whose point lies on one of the `edges` (see `points_on_edges`), or -1
+    Points are tested one after the other, so the search stops as soon as a valid point is found
+    """
+    for p in order:
+        px, py = pts[p, 0], pts[p, 1]
+        for e in range(len(edges)):
+            if min(edges[e, 0], edges[e, 2]) - tolerance <= px <= max(edges[e, 0], edges[e, 2]) + tolerance and is_on_segment(edges[e], px, py, tolerance):
+                return p
+    return -1
+
+@njit(cache=True, nogil=True)
+def edge_counts(edges, pts, tolerance, first_only):
+    """Returns the number of `edges` (rows (x1, y1, x2, y2)) through each point of `pts`, up to a distance `tolerance`
+    If `first_only`, points are only checked against edges until one contains them (counts are 0 or 1)
+    Otherwise an edge doesn't count the point at its first end (x1, y1): this vertex is shared with the previous edge of the polygon
+    (cf `polygon_edges`), which already counts it, so a vertex of a polygon counts once like a point inside one of its edges
+    Edges and points are swept along x: a point is only compared to the active edges, whose x range contains the point,
+    so it runs in O((n + m) log(n + m)) plus the number of edges crossed by the vertical lines through the points, without quadratic temporaries
+    """
+    xmin = np.minimum(edges[:, 0], edges[:, 2])
+    xmax = np.maximum(edges[:, 0], edges[:, 2])
+    edges_order = np.argsort(xmin)
+    active = np.empty(len(edges), dtype=np.int64)  # indices of the edges which can contain the next points
+    n_active = 0
+    next_edge = 0
+    counts = np.zeros(len(pts), dtype=np.int64)
+    for p in np.argsort(pts[:, 0]):
+        px, py = pts[p, 0], pts[p, 1]
+        while next_edge < len(edges) and xmin[edges_order[next_edge]] <= px + tolerance:
+            active[n_active] = edges_order[next_edge]
+            n_active += 1
+            next_edge += 1
+        k = 0
+        while k < n_active:
+            e = active[k]
+            if xmax[e] < px - tolerance:  # edge is on the left of all next points, it is removed from active edges
+                n_active -= 1
+                active[k] = active[n_active]
+                continue
+            if is_on_segment(edges[e], px, py, tolerance) and (
+                    first_only or abs(px - edges[e, 0]) > tolerance or abs(py - edges[e, 1]) > tolerance):
+                counts[p] += 1
+                if first_only:
+                    break
+            k += 1
+    return counts
+
+@njit(cache=True, nogil=True)
+def is_on_segment(edge, px, py, tolerance):
+    """Checks if the point (px, py) is at a distance lower or equal to `tolerance` from the segment `edge` (x1, y1, x2, y2)
+    It uses cross and dot products between the segment vector and the vector from the start of the segment to the point
+    """
+    vx, vy = edge[2] - edge[0], edge[3] - edge[1]
+    wx, wy = px - edge[0], py - edge[1]
+    length = math.sqrt(vx * vx + vy * vy)
+    if length == 0:
+        return math.sqrt(wx * wx + wy * wy) <= tolerance
+    cross_product = vx * wy - vy * wx
+    dot_product = vx * wx + vy * wy
+    return abs(cross_product) <= tolerance * length and -tolerance * length <= dot_product <= length * length + tolerance * length
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import numpy as np
+
+
+class NfpStore:
+    """Minkowski sums (see `prog.nfp.get_minkowski_sum`) saved in a SQLite file, so they are shared between runs and between processes
+    Several processes can read the file at the same time (SQLite write-ahead log mode), writes are serialized by SQLite
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.lock = threading.Lock()  # the connection is shared by the threads of the greedy parallel mode
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS nfps (key BLOB PRIMARY KEY, points BLOB NOT NULL)')
+            self.connection.commit()
+
+    def get(self, key):
+        """returns the points saved under `key`, or None"""
+        with self.lock:
+            row = self.connection.execute('SELECT points FROM nfps WHERE key = ?', (key, )).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype='<f8').reshape(-1, 2)
+
+    def put(self, key, points):
+        # the connection context commits the insert, or rolls it back if an exception interrupts it (e.g. the job timeout of prog.batch),
+        # so the connection is never left inside an open transaction that would block the writes of other processes
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO nfps (key, points) VALUES (?, ?)',
+                                    (key, np.ascontiguousarray(points, dtype='<f8').tobytes()))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def canonical_key(backend, *polygons):
+    """Content address of a minkowski sum: SHA-256 of the backend name and of the coordinates of the polygons (in order, as float64)
+    Unlike Python `hash()`, it cannot collide in practice and is the same in every process and run
+    """
+    digest = hashlib.sha256(backend.encode())
+    for polygon in polygons:
+        array = np.ascontiguousarray(polygon, dtype='<f8') + 0.0  # + 0.0 turns -0.0 into 0.0
+        digest.update(len(array).to_bytes(4, 'little'))
+        digest.update(array.tobytes())
+    return digest.digest()
@@ -0,0 +1,98 @@
+import json
+import numpy as np
+
+from prog.geometry import SCALE, unscale_polygon, unscale_translation
+from prog.snapshot import PlacementSnapshot, pack_polygons, unpack_polygons
+
+# Packings can be saved in two formats, both made of a part table and one record per placed polygon:
+# - 'jsonl': one JSON object per line, in this order:
+#   {"type": "packing", "bin_size": [x, y]}
+#   {"type": "part", "id": part id, "polygon": polygon as given in input}  (before the first placement of the part)
+#   {"type": "orientation", "part": part id, "id": orientation id, "polygon": transformed polygon}  (before its first placement)
+#   {"type": "placement", "bin": bin index, "part": part id, "orientation": orientation id, "tx": x translation, "ty": y translation}
+# - 'npz': numpy arrays of `PlacementSnapshot.to_arrays` (fixed point coordinates) with 'bin_size', 'scale' and the input parts
+# Part and orientation ids are the ones of the `OrientationTable` of the packing (cf prog.transform), so orientation ids 0 to 7 are
+# the flips and rotations of ORIENTATIONS. Both formats can be read by `load_packing` and given to `Packing(bin_size, polygons, bins)`
+# to go on with the nesting
+FORMATS = ('repr', 'jsonl', 'npz')  # 'repr' is the legacy format, Python representation of `Packing.unscaled_bins`, which can't be read back
+
+
+class JsonlWriter:
+    """Writes a packing in 'jsonl' format to the file object `f`, placement by placement, so nothing is kept in memory except the ids written"""
+
+    def __init__(self, f, bin_size):
+        self.f = f
+        self.parts = set()  # ids of the parts written
+        self.orientations = set()  # (part id, orientation id) of the orientations written
+        self.write_record(type='packing', bin_size=list(bin_size))
+
+    def write_record(self, **record):
+        self.f.write(json.dumps(record) + '\n')
+
+    def write(self, bin_idx, part_id, orient_id, polygon, transformed_polygon, translation):
+        """writes the placement of `transformed_polygon` (orientation `orient_id` of the part `part_id`, `polygon`) at `translation`
+        in the bin `bin_idx` (float coordinates)
+        """
+        if part_id not in self.parts:
+            self.parts.add(part_id)
+            self.write_record(type='part', id=part_id, polygon=polygon)
+        if (part_id, orient_id) not in self.orientations:
+            self.orientations.add((part_id, orient_id))
+            self.write_record(type='orientation', part=part_id, id=orient_id, polygon=transformed_polygon)
+        self.write_record(type='placement', bin=bin_idx, part=part_id, orientation=orient_id, tx=float(translation[0]), ty=float(translation[1]))
+
+
+def save_packing(packing, f, output_format='jsonl'):
+    """Writes `packing` to the file object `f` (opened in binary mode for 'npz') in the format `output_format`, see FORMATS"""
+    if output_format == 'repr':
+        f.write(str(packing.unscaled_bins()))
+    elif output_format == 'jsonl':
+        writer = JsonlWriter(f, packing.unscaled_bin_size)
+        snapshot = packing.placements()
+        table = snapshot.orientations
+        for idx in snapshot.order():
+            part_id, orient_id = int(snapshot['part_id'][idx]), int(snapshot['orient_id'][idx])
+            polygon = table.parts[part_id]
+            writer.write(int(snapshot['bin_id'][idx]), part_id, orient_id, packing.input_polygons.get(polygon, polygon),
+                         unscale_polygon(table.variant(part_id, orient_id)), unscale_translation((snapshot['tx'][idx], snapshot['ty'][idx])))
+    elif output_format == 'npz':
+        snapshot = packing.placements()
+        input_parts = [packing.input_polygons.get(polygon, polygon) for polygon in snapshot.orientations.parts]
+        input_vertices, input_offsets = pack_polygons(input_parts, dtype=np.float64)
+        np.savez_compressed(f, bin_size=np.array(packing.unscaled_bin_size, dtype=np.float64), scale=SCALE,
+                            input_vertices=input_vertices, input_offsets=input_offsets, **snapshot.to_arrays())
+    else:
+        raise ValueError("unknown output format: " + str(output_format))
+
+
+def load_packing(path):
+    """Reads a packing saved by `save_packing` in 'jsonl' or 'npz' format (by file extension .npz)
+    Returns (bin size, bins) with float coordinates, as expected by `Packing(bin_size, polygons, bins)`
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as arrays:
+            if int(arrays['scale']) != SCALE:
+                raise ValueError("packing saved with fixed point scale {}, current scale is {}".format(int(arrays['scale']), SCALE))
+            snapshot = PlacementSnapshot.from_arrays(arrays)
+            input_parts = unpack_polygons(arrays['input_vertices'], arrays['input_offsets'], float)
+            bin_size = tuple(float(x) for x in arrays['bin_size'])
+        input_polygons = dict(zip(snapshot.orientations.parts, input_parts))
+        return bin_size, [list(abin) for abin in snapshot.bins(input_polygons)]
+
+    parts, orientations, bins = {}, {}, []
+    bin_size = None
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['type'] == 'packing':
+                bin_size = tuple(record['bin_size'])
+            elif record['type'] == 'part':
+                parts[record['id']] = tuple(tuple(point) for point in record['polygon'])
+            elif record['type'] == 'orientation':
+                orientations[(record['part'], record['id'])] = tuple(tuple(point) for point in record['polygon'])
+            elif record['type'] == 'placement':
+                while len(bins) <= record['bin']:
+                    bins.append([])
+                bins[record['bin']].append((parts[record['part']], orientations[(record['part'], record['orientation'])],
+                                            np.array([record['tx'], record['ty']])))
+    return bin_size, bins
@@ -1,55 +1,126 @@
 import numpy as np
-from pydantic import BaseModel
 import random
 import copy
-from shapely.geometry import Polygon
 
-from prog.fitness import fitness
-from prog.nfp import find_nfp
-from prog.transform import apply_transformations
+from prog.fitness import fitness, polygon_array
+from prog.container import Bin
+from prog.snapshot import PlacementSnapshot
+from prog.nfp import find_best_nfp_pt
+from prog.transform import OrientationTable
+from prog.geometry import scale_polygon, scale_translation, to_fixed, polygon_area, polygon_bounds, polygon_size
 from prog.algos.simulated_annealing import SA
 from prog.algos.greedy import Greedy
+from prog.algos.parallel_tempering import ParallelTempering
+from prog.algos.genetic import Genetic
+import prog.nfp
+import prog.transform
 
 class Packing:
     """Class representing a packing (aka a nesting), that is a list of containers (aka bins) containing polygons with a certain position (aka translation)"""
     
     def __init__(self, bin_size, polygons, bins=None):
-        self.bin_size = bin_size  # bins are all the same size, defined by `bin_size` 
-        self.polygons = tuple(polygons.keys())  # polygons we want to fit inside bins (this contains only unique occurences of polygons)
-        self.remaining = polygons
+        # all coordinates are converted to fixed point integers once here (cf prog.geometry) and converted back by `unscaled_bins`
+        # `bin_size`, `polygons` and `bins` arguments are given with float coordinates
+        self.unscaled_bin_size = bin_size
+        self.bin_size = (to_fixed(bin_size[0]), to_fixed(bin_size[1]))  # bins are all the same size, defined by `bin_size` 
+        self.input_polygons = {}  # fixed point polygon: polygon as given in input
+        self.remaining = {}
+        for polygon, count in polygons.items():
+            scaled_polygon = scale_polygon(polygon)
+            self.input_polygons[scaled_polygon] = polygon
+            self.remaining[scaled_polygon] = self.remaining.get(scaled_polygon, 0) + count
+        self.polygons = tuple(self.remaining.keys())  # polygons we want to fit inside bins (this contains only unique occurences of polygons)
         
         # bins are initially empty except if specified in argument `bins`
-        # each bin is a list of tuples, each tuple in a bin contains the following: 
-        # (initial polygon: tuple(tuple(float, float)), transformed polygon: tuple(tuple(float, float)), translation to locate transformed polygon in the bin: np.array)
+        # each bin is a `Bin` (a list keeping its nfp unions cached, see prog.container), each tuple in a bin contains the following: 
+        # (initial polygon: tuple(tuple(int, int)), transformed polygon: tuple(tuple(int, int)), translation to locate transformed polygon in the bin: np.array)
         if bins is None:
             self.bins = []
         else:
-            self.bins = [[(x, y, np.array(z)) for x, y, z in abin] for abin in bins]
+            self.bins = [Bin([(scale_polygon(x), scale_polygon(y), scale_translation(z)) for x, y, z in abin]) for abin in bins]
+            for abin in bins:
+                for x, _, _ in abin:
+                    self.input_polygons.setdefault(scale_polygon(x), x)
+            # polygons of `bins` are already nested, only the other ones remain (e.g. when a saved packing is reloaded, cf prog.output)
+            for abin in self.bins:
+                for x, _, _ in abin:
+                    if x in self.remaining:
+                        self.remaining[x] -= 1
+            self.remaining = {polygon: count for polygon, count in self.remaining.items() if count > 0}
         
+        # every part is interned with its 8 orientations, algorithms, snapshots (see `placements`) and output formats
+        # find them by (part id, orientation id)
+        self.orientations = OrientationTable(self.polygons)
+        for abin in self.bins:
+            for x, _, _ in abin:
+                self.orientations.part_id(x)
+
         # fitness-fuction weights
         self.coeffs = (1/2, 1/2, 0)
         
-    def nest_all(self, isnotautogen, algo, sort, algo_extra):
-        """Will nest all polygons not yet nested according to remaining quantities"""
+    def nest_all(self, isnotautogen, algo, sort, algo_extra, workers=1, time_budget=None, max_iterations=None):
+        """Will nest all polygons not yet nested according to remaining quantities
+        `workers` is the number of processes used to search valid positions (greedy algorithm),
+        or the number of processes running the chains (parallel tempering algorithm) or decoding the genomes (genetic algorithm)
+        `time_budget` (in seconds) and `max_iterations` limit the number of moves of simulated annealing algorithm,
+        or the number of generations of genetic algorithm
+        """
         if algo == 'initial':
             self.make_initial_nesting(sort)
         elif algo == 'greedy':
-            greedy_algo = Greedy(self, sort)
+            greedy_algo = Greedy(self, sort, workers)
             greedy_algo.greedy()
+            if isnotautogen:
+                print("NFP queries:", greedy_algo.nfp_queries)
+                print("NFP queries pruned:", greedy_algo.pruned_queries)
             self = greedy_algo.packing
         elif algo == 'simulated annealing':
             initial_temperature = algo_extra[0]
             decrease_rate = algo_extra[1]
             SA_algo = SA(self, sort, initial_temperature, decrease_rate)
-            sum_changes, poss_changes, init_fitness = SA_algo.simulated_annealing()
+            sum_changes, poss_changes, init_fitness = SA_algo.simulated_annealing(time_budget, max_iterations)
             if isnotautogen:
                 print("Initial fitness:", init_fitness)
                 print("Number of changes:", sum_changes)
                 print("Number of changes after possibility calculation:", poss_changes)
+                if SA_algo.best_fitness is not None:
+                    print("Number of moves:", SA_algo.iterations)
             self = SA_algo.packing
-        # elif mode == 'genetic':
-        #     self.make_initial_nesting(sort)
+        elif algo == 'parallel tempering':
+            initial_temperature, decrease_rate, chains, exchange_interval, seed = algo_extra
+            PT_algo = ParallelTempering(self, sort, initial_temperature, decrease_rate, chains, exchange_interval, seed, workers)
+            sum_changes, init_fitness, best_fitness = PT_algo.parallel_tempering()
+            if isnotautogen:
+                print("Initial fitness:", init_fitness)
+                print("Number of changes:", sum_changes)
+                print("Exchanges between chains:", PT_algo.exchanges, "accepted out of", PT_algo.exchange_attempts)
+                print("Best fitness of all chains:", best_fitness)
+            self = PT_algo.packing
+        elif algo == 'genetic':
+            population_size, generations, mutation_rate, seed = algo_extra
+            GA_algo = Genetic(self, sort, population_size, generations, mutation_rate, seed, workers)
+            first_fitness, best_fitness = GA_algo.genetic(time_budget, max_iterations)
+            if isnotautogen:
+                print("Initial order fitness (first fit):", first_fitness)
+                print("Generations:", GA_algo.generation)
+                print("Genomes decoded:", GA_algo.decoded, "fitnesses reused:", GA_algo.cache_hits)
+                print("Placements replayed from decoded prefixes:", GA_algo.replayed, "out of", GA_algo.placements)
+                report = GA_algo.prefix_report()
+                if report is not None:
+                    print("Prefix cache hits:", report['hits'], "out of", report['lookups'],
+                          "mean hit depth: {:.1f} max hit depth: {}".format(report['mean_hit_depth'], report['max_hit_depth']),
+                          "memory: {:.1f} MB".format(report['memory'] / 2 ** 20))
+                print("Best fitness:", best_fitness)
+            self = GA_algo.packing
+    
     
+    def placements(self):
+        """returns a snapshot of the bins as a `PlacementSnapshot` (cf prog.snapshot), built from the bins at each call, e.g. to keep, send or save them"""
+        return PlacementSnapshot.from_bins(self.bins, self.orientations)
+
+    def unscaled_bins(self):
+        """returns a lazy view of the bins with float coordinates, initial polygons being the ones given in input"""
+        return self.placements().bins(self.input_polygons)
     
     # def sort_figures_before_nesting()
     
@@ -61,7 +132,7 @@ class Packing:
                 polygon = random.choice(list(self.remaining.keys()))
                 self.initial_polygon_nest(polygon, sort)
         elif sort == 'descending area':
-            polygons = dict(sorted(self.remaining.items(), key=lambda pg: Polygon(pg[0]).area, reverse=True))
+            polygons = dict(sorted(self.remaining.items(), key=lambda pg: self.orientations.areas[self.orientations.part_id(pg[0])], reverse=True))
             for polygon in polygons:
                 for _ in range(self.remaining[polygon]):
                     self.initial_polygon_nest(polygon, sort)
@@ -69,33 +140,46 @@ class Packing:
         
     def initial_polygon_nest(self, polygon, sort):
         for abin in self.bins[-1:]:    
-            valid_pts = find_nfp(abin, self.bin_size, polygon)
-            if len(valid_pts):
-                best_pts = list(valid_pts)
-                best_pts.sort(key=lambda x: x[0])
-                best_pts.sort(key=lambda x: x[1])
-                best_pt = best_pts[0]
+            best_pt = find_best_nfp_pt(abin, self.bin_size, polygon)
+            if best_pt is not None:
                 abin.append((polygon, polygon, best_pt))
                 break
         else:  # if else statement is executed, it means that the polygon did not fit in any existing bins, we need to add a new bin
             # TODO: check if polygon fits alone in a new bin
-            self.bins.append([(polygon, polygon, np.zeros(2))])
+            self.bins.append(Bin([(polygon, polygon, np.zeros(2))]))
 
         self.remaining[polygon] -= 1
         if sort == 'random' and (not self.remaining[polygon]):
             self.remaining.pop(polygon)
 
+
+def clear_caches():
+    """empties the caches shared by all nestings of the process: minkowski sums, transformations and the lru caches of polygon properties"""
+    prog.nfp.SINGLE_NFPS.clear()
+    prog.transform.TRANSFORMATIONS.clear()
+    for cached in (polygon_area, polygon_bounds, polygon_size, polygon_array):
+        cached.cache_clear()
+
     
 def available_polygons(self):
     """returns polygons whose remaining quantities are not 0"""
     return [k for k,v in self.remaining.items() if v > 0]
     
+def placement_rows(self):
+    """returns the placed polygons, bin by bin, as an int64 array of rows (bin index, part id, orientation id, x translation, y translation)"""
+    orientations = self.orientations
+    rows = []
+    for bin_id, abin in enumerate(self.bins):
+        for x, y, z in abin:
+            part_id = orientations.part_id(x)
+            rows.append((bin_id, part_id, orientations.orient_id(part_id, y), round(z[0]), round(z[1])))
+    return np.array(rows, dtype=np.int64).reshape(-1, 5)
+    
 def hashable_bins(self):
-    """returns current bins as nested tuples, so they are hashable and can be used in `dict` as keys"""
-    return tuple([tuple([(x, y, tuple(z)) for x, y, z in abin]) 
-                      for abin in self.bins])
+    """returns current bins as bytes, so they are hashable and can be used in `dict` as keys"""
+    return placement_rows(self).tobytes()
     
 def get_n_last(self, n_last):
-    """return n last polygons (ignoring bins)"""
-    all_polygons = [(x, y, tuple(z)) for abin in self.bins for x, y, z in abin]
-    return tuple(all_polygons[-n_last:])
+    """return n last polygons (ignoring bins) as bytes"""
+    rows = placement_rows(self)
+    return rows[len(rows) - min(n_last, len(rows)):, 1:].tobytes()
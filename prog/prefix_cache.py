@@ -0,0 +1,115 @@
+from collections import OrderedDict
+import numpy as np
+
+# Cache of decoded genomes for sequence based search (see prog.algos.genetic): genomes sharing a prefix of (part id, orientation id)
+# are placed identically along this prefix, so decoding a genome can start from the deepest prefix already decoded.
+# Genomes are kept in a trie, each decoded genome is saved once as compact arrays of its placements (bin index and translation of each gene),
+# and every trie node on its path refers to it: the state after any prefix is the first placements of the record.
+PREFIX_CACHE_BYTES = 64 * 2 ** 20  # maximal memory of the cache (see `PrefixCache.memory`), least recently used genomes are evicted first
+NODE_BYTES = 200  # approximate size of a trie node (object and dict entry)
+
+
+class TrieNode:
+    __slots__ = ('children', 'record')
+
+    def __init__(self, record=None):
+        self.children = {}  # (part id, orientation id): TrieNode
+        self.record = record  # `PrefixRecord` of a genome going through this node
+
+
+class PrefixRecord:
+    """placements of a decoded genome: bin index and translation of each gene, in the order of the genome"""
+    __slots__ = ('genome', 'bin_ids', 'translations')
+
+    def __init__(self, genome, bin_ids, translations):
+        self.genome = genome
+        self.bin_ids = np.array(bin_ids, dtype=np.int32)
+        self.translations = np.array(translations, dtype=np.int64).reshape(-1, 2)
+
+    @property
+    def nbytes(self):
+        return self.genome.nbytes + self.bin_ids.nbytes + self.translations.nbytes
+
+
+class PrefixCache:
+    """Trie of decoded genomes (arrays of rows (part id, orientation id)) bounded by `max_bytes` of `memory()`, see `lookup` and `insert`"""
+
+    def __init__(self, max_bytes=PREFIX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.root = TrieNode()
+        self.records = OrderedDict()  # genome bytes: `PrefixRecord`, least recently used first
+        self.nbytes = 0  # size of the saved records
+        self.nodes = 0
+        self.lookups = 0
+        self.hits = 0  # lookups which found a prefix
+        self.hit_depth = 0  # sum of the depths found
+        self.max_depth = 0
+
+    def lookup(self, genome):
+        """returns (depth, record) for the deepest decoded prefix of `genome` (the first `depth` placements of `record` are its placements),
+        or (0, None) if no genome starts like it
+        """
+        node, depth = self.root, 0
+        for gene in genome:
+            child = node.children.get((int(gene[0]), int(gene[1])))
+            if child is None:
+                break
+            node, depth = child, depth + 1
+        self.lookups += 1
+        if not depth:
+            return 0, None
+        self.hits += 1
+        self.hit_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+        self.records.move_to_end(node.record.genome.tobytes())
+        return depth, node.record
+
+    def insert(self, genome, bin_ids, translations):
+        """saves the placements of the decoded `genome`, least recently used genomes are evicted while the cache (records and nodes) is too large"""
+        key = genome.tobytes()
+        if key in self.records:
+            self.records.move_to_end(key)
+            return
+        record = PrefixRecord(genome.copy(), bin_ids, translations)
+        if record.nbytes + len(genome) * NODE_BYTES > self.max_bytes:  # it could not fit alone with all its nodes
+            return
+        node = self.root
+        for gene in genome:
+            gene = (int(gene[0]), int(gene[1]))
+            child = node.children.get(gene)
+            if child is None:
+                child = node.children[gene] = TrieNode()
+                self.nodes += 1
+            child.record = record
+            node = child
+        self.records[key] = record
+        self.nbytes += record.nbytes
+        while self.memory() > self.max_bytes:
+            self.evict(next(iter(self.records.values())))
+
+    def evict(self, record):
+        """removes `record`, nodes of its path refer to another genome of their subtree, or are removed if there is none"""
+        del self.records[record.genome.tobytes()]
+        self.nbytes -= record.nbytes
+        path = [self.root]
+        for gene in record.genome:
+            path.append(path[-1].children[(int(gene[0]), int(gene[1]))])
+        for depth in range(len(path) - 1, 0, -1):  # deepest nodes first, so their parents see their new records
+            node = path[depth]
+            if node.record is not record:  # a more recent genome goes through this node
+                continue
+            if node.children:
+                node.record = next(iter(node.children.values())).record
+            else:
+                gene = record.genome[depth - 1]
+                del path[depth - 1].children[(int(gene[0]), int(gene[1]))]
+                self.nodes -= 1
+
+    def memory(self):
+        """approximate memory use in bytes: saved placements and trie nodes"""
+        return self.nbytes + self.nodes * NODE_BYTES
+
+    def report(self):
+        """counters of the lookups and size of the cache, see `prog.algos.genetic.Genetic.prefix_report` for several caches"""
+        return {'lookups': self.lookups, 'hits': self.hits, 'mean_hit_depth': self.hit_depth / self.hits if self.hits else 0.0,
+                'max_hit_depth': self.max_depth, 'genomes': len(self.records), 'nodes': self.nodes, 'memory': self.memory()}
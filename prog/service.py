@@ -0,0 +1,420 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import sys
+import time
+import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, Pipe
+import numpy as np
+
+import prog.nfp
+from prog import input_data, algo_parameters, init_worker
+from prog.batch import run_job
+from prog.geometry import polygon_area
+from prog.packing import Packing, clear_caches
+from prog.fitness import fitness
+from prog.output import save_packing
+from prog.nfp import PLACEMENT_POLICIES
+from prog.warmup import warmup
+
+# Local nesting service, run it with `python -m prog.service` (see --help and the README)
+# Jobs are posted over HTTP (TCP on localhost, or a Unix socket), queued, and nested by long-lived worker processes, one per dispatcher:
+# each worker compiles (or loads) the numba functions once at start (see prog.warmup) and keeps its caches of minkowski sums
+# and transformed polygons between jobs, and all workers share the persistent cache of minkowski sums if one is given (--nfp-cache).
+# A job is stopped by an alarm in its worker after the job timeout, but an alarm can't interrupt a clipper or numba call:
+# a worker still busy KILL_GRACE seconds later is killed by its dispatcher and replaced by a new one.
+# Routes:
+#   POST /jobs                job as JSON (see `parse_job`) or as a classic input file, ?wait=1 answers when the job is finished
+#   GET  /jobs/<id>           status and result of a job, ?wait=1 waits for its end
+#   GET  /jobs/<id>/output    nested bins of a finished job in the output format of the job ('jsonl' by default, cf prog.output)
+#   GET  /metrics             queue depth, running jobs, finished jobs by status and latencies
+#   GET  /health
+ALGORITHMS = ('greedy', 'simulated annealing', 'parallel tempering', 'genetic')
+SORTS = ('descending area', 'random')
+OUTPUT_FORMATS = ('jsonl', 'repr')  # text formats of prog.output
+MAX_QUEUE = 1000  # jobs waiting for a worker, more jobs are refused (503)
+MAX_FINISHED_JOBS = 1000  # finished jobs kept for GET /jobs/<id>, oldest ones are forgotten first
+MAX_BODY_BYTES = 16 * 2 ** 20
+MAX_CACHED_NFPS = 200000  # a worker empties its caches (see `prog.packing.clear_caches`) before a job when it holds more minkowski sums
+MAX_CACHED_POLYGONS = 100000  # or more polygons in its caches of polygon properties
+KILL_GRACE = 1.0  # seconds after the job timeout before a worker is killed
+LATENCY_WINDOW = 1000  # number of last finished jobs whose latencies are summarized in the metrics
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict',
+           413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def init_service_worker(nfp_store_path, fitness_backend, placement_policy, profile, warm):
+    """initializer of the worker processes: warm-up (before the persistent cache is set, so warm-up polygons are not saved in it),
+    then settings of the service
+    """
+    if warm:
+        warmup()
+    init_worker(nfp_store_path, fitness_backend, profile, placement_policy)
+
+
+def serve_jobs(connection, initargs):
+    """Worker process of the service: runs the tasks of `prog.batch.run_job` it is sent one at a time and sends their records back,
+    until it gets None, see class ServiceWorker
+    """
+    init_service_worker(*initargs)
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        connection.send(run_job(task))
+
+
+class ServiceWorker:
+    """Worker process of a dispatcher, see `NestingService.dispatch`"""
+
+    def __init__(self, initargs):
+        self.connection, worker_connection = Pipe()
+        self.process = Process(target=serve_jobs, args=(worker_connection, initargs), daemon=True)
+        self.process.start()
+        worker_connection.close()
+
+    def run(self, task):
+        """sends `task` to the worker and returns its record, blocks until the job is finished (raises EOFError if the worker died)"""
+        self.connection.send(task)
+        return self.connection.recv()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+    def close(self):
+        try:
+            self.connection.send(None)
+        except (OSError, ValueError):  # the worker is already gone
+            pass
+        self.process.join(KILL_GRACE)
+        self.kill()
+
+
+def nest_job(spec):
+    """Nests the job `spec` (see `parse_job`) in a worker process, returns (number of polygons, number of bins, time, fitness, other fields)"""
+    if len(prog.nfp.SINGLE_NFPS) > MAX_CACHED_NFPS or polygon_area.cache_info().currsize > MAX_CACHED_POLYGONS:
+        clear_caches()
+    if spec['seed'] is not None:
+        random.seed(spec['seed'])
+        np.random.seed(spec['seed'])
+    packing = Packing(spec['bin_size'], spec['polygons'])
+    time1 = time.time()
+    packing.nest_all(False, spec['algorithm'], spec['sort'], spec['parameters'], 1, spec['time_budget'], spec['max_iterations'])
+    duration = time.time() - time1
+    fit = fitness(packing.bins, packing.bin_size, packing.coeffs)
+    output = io.StringIO()
+    save_packing(packing, output, spec['format'])
+    return (sum(spec['polygons'].values()), len(packing.bins), duration, fit,
+            {'output': output.getvalue(), 'worker': os.getpid(), 'cached_nfps': len(prog.nfp.SINGLE_NFPS)})
+
+
+def parse_job(body, query):
+    """Returns the job described by the request `body`, either a classic input file or a JSON object:
+    {"parts": [{"polygon": [[x, y], ...], "count": n}, ...], "bin_size": [x, y],
+     "algorithm": "greedy", "parameters": [...], "sort": "descending area"}
+    where "parameters" are the lines following the algorithm in a classic input file (cf `prog.algo_parameters`).
+    Options "time_budget", "max_iterations", "seed" and "format" are read from the JSON object or from the query string
+    """
+    try:
+        if body.lstrip().startswith(b'{'):
+            data = json.loads(body)
+            polygons = {}
+            for part in data['parts']:
+                polygon = tuple((float(x), float(y)) for x, y in part['polygon'])
+                if len(polygon) < 3 or int(part['count']) < 1:
+                    raise ValueError('a part needs 3 vertices and a positive count')
+                polygons[polygon] = polygons.get(polygon, 0) + int(part['count'])
+            bin_size = tuple(float(x) for x in data['bin_size'])
+            algo = data.get('algorithm', 'greedy')
+            sort = data.get('sort', 'descending area')
+            algo_extra, rest = algo_parameters(algo, [str(value) for value in data.get('parameters', [])] + [''])
+            if rest != ['']:
+                raise ValueError('too many parameters for ' + algo)
+        else:
+            mode, *instance = input_data(body.decode().splitlines())
+            if mode != 'classic_input':
+                raise ValueError('only classic input files can be nested by the service')
+            polygons, bin_size, algo, algo_extra, sort = instance
+            data = {}
+        options = dict(data, **query)
+        spec = {'polygons': polygons, 'bin_size': bin_size, 'algorithm': algo, 'parameters': algo_extra, 'sort': sort,
+                'time_budget': None, 'max_iterations': None, 'seed': None, 'format': options.get('format', 'jsonl')}
+        for name, convert in (('time_budget', float), ('max_iterations', int), ('seed', int)):
+            if options.get(name) is not None:
+                spec[name] = convert(options[name])
+    except HTTPError:
+        raise
+    except (ValueError, KeyError, TypeError, IndexError) as e:
+        raise HTTPError(400, 'invalid job: ' + str(e))
+    if algo not in ALGORITHMS:
+        raise HTTPError(400, 'unknown algorithm: ' + str(algo))
+    if sort not in SORTS:
+        raise HTTPError(400, 'unknown sort: ' + str(sort))
+    if spec['format'] not in OUTPUT_FORMATS:
+        raise HTTPError(400, 'unknown output format: ' + str(spec['format']))
+    if spec['seed'] is not None and algo in ('parallel tempering', 'genetic'):  # like the key --seed, it overrides the seed of the input
+        spec['parameters'][-1] = spec['seed']
+    return spec
+
+
+def summary(values):
+    """count, mean, median, 95th percentile and maximum of `values` (durations in seconds)"""
+    if not values:
+        return {'count': 0}
+    values = np.array(values)
+    return {'count': len(values), 'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+
+
+class Job:
+    def __init__(self, job_id, spec):
+        self.id = job_id
+        self.spec = spec
+        self.status = 'queued'  # then 'running', then the status of `prog.batch.run_job`: 'ok', 'timeout' or 'error'
+        self.record = {}
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.finished = None
+        self.done = asyncio.Event()
+
+    def to_dict(self):
+        job = {'id': self.id, 'status': self.status, 'algorithm': self.spec['algorithm'], 'parts': sum(self.spec['polygons'].values())}
+        if self.started is not None:
+            job['queue_wait'] = self.started - self.submitted
+        if self.finished is not None:
+            job['latency'] = self.finished - self.submitted
+        job.update((name, value) for name, value in self.record.items() if name not in ('filename', 'status', 'output'))
+        return job
+
+
+class NestingService:
+    """Queue of nesting jobs run by `workers` warm processes, and the HTTP handler of the service"""
+
+    def __init__(self, workers=1, nfp_store_path=None, fitness_backend='shapely', placement_policy='bottom left', job_timeout=None,
+                 profile=False, warm=True, max_queue=MAX_QUEUE):
+        self.workers = workers
+        self.job_timeout = job_timeout
+        self.max_queue = max_queue
+        self.initargs = (nfp_store_path, fitness_backend, placement_policy, profile, warm)
+        self.service_workers = []  # `ServiceWorker` of each dispatcher
+        self.executor = None  # threads waiting for the records of the workers
+        self.queue = None
+        self.dispatchers = []
+        self.jobs = OrderedDict()  # job id: `Job`, in order of submission
+        self.next_id = 1
+        self.running = 0
+        self.submitted = 0
+        self.refused = 0
+        self.finished = {}  # status: number of jobs
+        self.queue_waits = deque(maxlen=LATENCY_WINDOW)
+        self.run_times = deque(maxlen=LATENCY_WINDOW)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.worker_jobs = {}  # pid: number of jobs run by this worker
+        self.killed_workers = 0  # workers killed after a job timeout or dead during a job, and replaced
+        self.start_time = time.perf_counter()
+
+    def start(self):
+        """starts the worker processes (they warm up at once) and one dispatcher per worker, in the running event loop"""
+        self.service_workers = [ServiceWorker(self.initargs) for _ in range(self.workers)]
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.queue = asyncio.Queue()
+        self.dispatchers = [asyncio.ensure_future(self.dispatch(k)) for k in range(self.workers)]
+
+    def close(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.cancel()
+        for worker in self.service_workers:
+            worker.kill()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def submit(self, spec):
+        if self.queue.qsize() >= self.max_queue:
+            self.refused += 1
+            raise HTTPError(503, 'queue is full')
+        job = Job(str(self.next_id), spec)
+        self.next_id += 1
+        self.jobs[job.id] = job
+        self.submitted += 1
+        self.queue.put_nowait(job)
+        return job
+
+    async def dispatch(self, k):
+        """runs the queued jobs one at a time in the worker `k`, so the queue depth is the number of jobs waiting for a worker
+        A worker still running a job KILL_GRACE seconds after the job timeout (or dead) is killed and replaced
+        """
+        loop = asyncio.get_running_loop()
+        limit = None if self.job_timeout is None else self.job_timeout + KILL_GRACE
+        while True:
+            job = await self.queue.get()
+            job.status = 'running'
+            job.started = time.perf_counter()
+            self.running += 1
+            worker = self.service_workers[k]
+            try:
+                task = (nest_job, job.id, job.spec, self.job_timeout)
+                job.record = await asyncio.wait_for(loop.run_in_executor(self.executor, worker.run, task), limit)
+            except Exception as e:  # the worker didn't stop in time, or the job could not be sent to or received from it
+                timeout = isinstance(e, asyncio.TimeoutError)
+                job.record = {'status': 'timeout' if timeout else 'error', 'time': time.perf_counter() - job.started}
+                if not timeout:
+                    job.record['error'] = repr(e)
+                worker.kill()  # its waiting thread gets an EOFError
+                self.service_workers[k] = ServiceWorker(self.initargs)
+                self.killed_workers += 1
+            finally:
+                self.running -= 1
+            self.finish(job)
+
+    def finish(self, job):
+        job.finished = time.perf_counter()
+        job.status = job.record['status']
+        self.finished[job.status] = self.finished.get(job.status, 0) + 1
+        self.queue_waits.append(job.started - job.submitted)
+        self.run_times.append(job.finished - job.started)
+        self.latencies.append(job.finished - job.submitted)
+        if 'worker' in job.record:
+            self.worker_jobs[job.record['worker']] = self.worker_jobs.get(job.record['worker'], 0) + 1
+        job.done.set()
+        finished = [job_id for job_id, other in self.jobs.items() if other.finished is not None]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def metrics(self):
+        return {'workers': self.workers, 'queue_depth': self.queue.qsize(), 'running': self.running, 'submitted': self.submitted,
+                'refused': self.refused, 'finished': self.finished, 'uptime': time.perf_counter() - self.start_time,
+                'queue_wait': summary(self.queue_waits), 'run_time': summary(self.run_times), 'latency': summary(self.latencies),
+                'worker_jobs': {str(pid): count for pid, count in self.worker_jobs.items()}, 'killed_workers': self.killed_workers}
+
+    def get_job(self, job_id):
+        if job_id not in self.jobs:
+            raise HTTPError(404, 'unknown job: ' + job_id)
+        return self.jobs[job_id]
+
+    async def route(self, method, path, query, body):
+        """returns (status, content type, body) of the answer to a request"""
+        parts = path.strip('/').split('/')
+        wait = query.pop('wait', '0') not in ('0', 'false', '')
+        if parts == ['jobs'] and method == 'POST':
+            job = self.submit(parse_job(body, query))
+            if not wait:
+                return 202, 'application/json', job.to_dict()
+            await job.done.wait()
+            return 200, 'application/json', job.to_dict()
+        if method != 'GET':
+            raise HTTPError(405, 'method not allowed: ' + method)
+        if parts == ['metrics']:
+            return 200, 'application/json', self.metrics()
+        if parts == ['health']:
+            return 200, 'application/json', {'status': 'ok'}
+        if len(parts) == 2 and parts[0] == 'jobs':
+            job = self.get_job(parts[1])
+            if wait:
+                await job.done.wait()
+            return 200, 'application/json', job.to_dict()
+        if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'output':
+            job = self.get_job(parts[1])
+            if job.status != 'ok':
+                raise HTTPError(409, 'job {} is {}'.format(job.id, job.status))
+            return 200, 'application/x-ndjson' if job.spec['format'] == 'jsonl' else 'text/plain', job.record['output']
+        raise HTTPError(404, 'not found: ' + path)
+
+    async def handle(self, reader, writer):
+        """answers one HTTP/1.1 request of the connection, then closes it"""
+        try:
+            try:
+                method, path, query, body = await read_request(reader)
+                status, content_type, content = await self.route(method, path, query, body)
+            except HTTPError as e:
+                status, content_type, content = e.status, 'application/json', {'error': e.message}
+            except Exception as e:
+                status, content_type, content = 500, 'application/json', {'error': repr(e)}
+            if content_type == 'application/json':
+                content = json.dumps(content)
+            content = content.encode()
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                status, REASONS.get(status, ''), content_type, len(content)).encode() + content)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):  # the client went away
+            pass
+        finally:
+            writer.close()
+
+
+async def read_request(reader):
+    """returns (method, path, query parameters, body) of the HTTP request read from `reader`"""
+    request_line = (await reader.readline()).decode('latin-1').split()
+    if len(request_line) != 3:
+        raise HTTPError(400, 'invalid request line')
+    method, target, _ = request_line
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, 'request body larger than {} bytes'.format(MAX_BODY_BYTES))
+    body = await reader.readexactly(length) if length else b''
+    url = urllib.parse.urlsplit(target)
+    return method, url.path, dict(urllib.parse.parse_qsl(url.query)), body
+
+
+async def serve(service, host='127.0.0.1', port=8765, unix_socket=None):
+    service.start()
+    try:
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(service.handle, unix_socket)
+            print('Nesting service listening on', unix_socket, flush=True)
+        else:
+            server = await asyncio.start_server(service.handle, host, port)
+            print('Nesting service listening on http://{}:{}'.format(host, port), flush=True)
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local nesting service: jobs posted over HTTP are nested by a pool of warm worker processes')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8765, type=int)
+    parser.add_argument('--unix-socket', default=None, help='listen on this Unix socket instead of TCP')
+    parser.add_argument('-w', '--workers', default=os.cpu_count(), type=int)
+    parser.add_argument('--nfp-cache', default=None, help='SQLite file of minkowski sums shared by all workers')
+    parser.add_argument('--fitness-backend', default='shapely', choices=['shapely', 'numba'])
+    parser.add_argument('--placement', default='bottom left', choices=PLACEMENT_POLICIES)
+    parser.add_argument('--job-timeout', default=None, type=float)
+    parser.add_argument('--max-queue', default=MAX_QUEUE, type=int)
+    parser.add_argument('--profile', action='store_const', const=True, help='add the stats of each job to its result, see prog/stats.py')
+    parser.add_argument('--no-warmup', action='store_const', const=True)
+    namespace = parser.parse_args(sys.argv[1:])
+    service = NestingService(namespace.workers, namespace.nfp_cache, namespace.fitness_backend, namespace.placement, namespace.job_timeout,
+                             bool(namespace.profile), not namespace.no_warmup, namespace.max_queue)
+    try:
+        asyncio.run(serve(service, namespace.host, namespace.port, namespace.unix_socket))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
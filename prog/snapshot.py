@@ -0,0 +1,153 @@
+import numpy as np
+
+from prog.container import Bin
+from prog.geometry import unscale_polygon, unscale_translation
+from prog.transform import OrientationTable
+
+PLACEMENT_FIELDS = ('part_id', 'orient_id', 'bin_id', 'tx', 'ty')
+PLACEMENT_DTYPES = {'part_id': np.int32, 'orient_id': np.int32, 'bin_id': np.int32, 'tx': np.int64, 'ty': np.int64}
+
+
+class PlacementSnapshot:
+    """Snapshot of a packing in arrays: a table of parts and one row of arrays per placed polygon
+    - orientations: `OrientationTable` of the parts (fixed point polygons, cf prog.geometry) and their orientations (cf prog.transform),
+      usually the one of the packing, so `part_id` and `orient_id` are the ids used by the algorithms and the output formats
+    - placements: arrays `part_id`, `orient_id`, `bin_id` and translation `tx`, `ty` (fixed point integers), bin by bin
+    The working state of a packing is `Packing.bins` (lists of `Bin`, whose nfp unions are cached), algorithms modify it in place.
+    A snapshot is built from these bins (see `Packing.placements`) to keep a packing (best state of simulated annealing),
+    to send it to another process (states of parallel tempering chains) or to save it (cf prog.output), and `to_bins` rebuilds the bins
+    """
+
+    def __init__(self, orientations=None):
+        self.orientations = OrientationTable() if orientations is None else orientations
+        self.size = 0
+        self.arrays = {field: np.empty(0, dtype=PLACEMENT_DTYPES[field]) for field in PLACEMENT_FIELDS}
+
+    @classmethod
+    def from_bins(cls, bins, orientations=None):
+        """builds a snapshot of a list of bins (lists of tuples (initial polygon, transformed polygon, translation), cf class Packing)"""
+        snapshot = cls(orientations)
+        table = snapshot.orientations
+        rows = []
+        for bin_id, abin in enumerate(bins):
+            for polygon, transformed_polygon, translation in abin:
+                part_id = table.part_id(polygon)
+                rows.append((part_id, table.orient_id(part_id, transformed_polygon), bin_id, round(translation[0]), round(translation[1])))
+        snapshot.size = len(rows)
+        columns = zip(*rows) if rows else [()] * len(PLACEMENT_FIELDS)
+        snapshot.arrays = {field: np.array(column, dtype=PLACEMENT_DTYPES[field]) for field, column in zip(PLACEMENT_FIELDS, columns)}
+        return snapshot
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, field):
+        """array of the field `field` (see PLACEMENT_FIELDS) for all placements"""
+        return self.arrays[field][:self.size]
+
+    def n_bins(self):
+        return int(self['bin_id'].max()) + 1 if self.size else 0
+
+    def order(self):
+        """indices of the placements sorted by bin, in insertion order inside a bin (order of class Packing bins)"""
+        return np.argsort(self['bin_id'], kind='stable')
+
+    def bins(self, input_polygons=None):
+        """Returns a lazy view of the placements as bins, see class BinsView"""
+        return BinsView(self, input_polygons)
+
+    def to_bins(self):
+        """returns the placements as a list of `Bin`, that algorithms can modify"""
+        bins = [Bin() for _ in range(self.n_bins())]
+        for idx in self.order():
+            bins[self['bin_id'][idx]].append(self.placement(idx))
+        return bins
+
+    def placement(self, idx):
+        """returns the placement `idx` as a tuple (initial polygon, transformed polygon, translation)"""
+        part_id = self['part_id'][idx]
+        return (self.orientations.parts[part_id], self.orientations.variant(part_id, self['orient_id'][idx]),
+                np.array([self['tx'][idx], self['ty'][idx]]))
+
+    def to_arrays(self):
+        """Returns the snapshot as a dict of numpy arrays (e.g. for `np.savez`), polygons being given as vertices and offsets:
+        the parts of the orientation table, and all their orientations, part by part in the order of orientation ids
+        """
+        parts = self.orientations.parts
+        orientations = [(part_id, pg) for part_id, pgs in enumerate(self.orientations.variants) for pg in pgs]
+        arrays = {field: self[field].copy() for field in PLACEMENT_FIELDS}
+        arrays['part_vertices'], arrays['part_offsets'] = pack_polygons(parts)
+        arrays['orientation_vertices'], arrays['orientation_offsets'] = pack_polygons([pg for _, pg in orientations])
+        arrays['orientation_part'] = np.array([part_id for part_id, _ in orientations], dtype=np.int32)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, orientations=None):
+        """inverse of `to_arrays`, ids are those of the table `orientations` (e.g. the one of the packing, or a new table):
+        saved parts and orientations are found in it (or added to it) by polygon
+        """
+        snapshot = cls(orientations)
+        table = snapshot.orientations
+        part_map = np.array([table.part_id(polygon) for polygon in unpack_polygons(arrays['part_vertices'], arrays['part_offsets'])],
+                            dtype=np.int32)
+        saved_parts = np.asarray(arrays['orientation_part'])
+        orient_map = np.array([table.orient_id(int(part_map[part_id]), polygon) for part_id, polygon in
+                               zip(saved_parts, unpack_polygons(arrays['orientation_vertices'], arrays['orientation_offsets']))], dtype=np.int32)
+        # orientations are saved part by part, so the saved orientation k of part p is the row first_rows[p] + k
+        first_rows = np.searchsorted(saved_parts, np.arange(len(part_map)))
+        saved_part_ids = np.asarray(arrays['part_id'], dtype=np.int64)
+        snapshot.size = len(arrays['bin_id'])
+        snapshot.arrays = {field: np.array(arrays[field], dtype=PLACEMENT_DTYPES[field]) for field in PLACEMENT_FIELDS}
+        snapshot.arrays['part_id'] = part_map[saved_part_ids]
+        snapshot.arrays['orient_id'] = orient_map[first_rows[saved_part_ids] + np.asarray(arrays['orient_id'], dtype=np.int64)]
+        return snapshot
+
+
+class BinsView:
+    """Read-only view of a `PlacementSnapshot` with the interface of `Packing.bins` (a list of bins, each bin a list of tuples)
+    Tuples are only built when a bin is accessed. If `input_polygons` (fixed point polygon: input polygon, cf class Packing) is given,
+    coordinates are converted back to floats and initial polygons are the ones given in input
+    """
+
+    def __init__(self, snapshot, input_polygons=None):
+        self.snapshot = snapshot
+        self.input_polygons = input_polygons
+        order = snapshot.order()
+        # placements of bin i are order[starts[i]:starts[i + 1]]
+        self.order = order
+        self.starts = np.searchsorted(snapshot['bin_id'][order], np.arange(snapshot.n_bins() + 1))
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('bin index out of range')
+        abin = [self.snapshot.placement(i) for i in self.order[self.starts[idx]:self.starts[idx + 1]]]
+        if self.input_polygons is None:
+            return abin
+        return [(self.input_polygons.get(x, x), unscale_polygon(y), unscale_translation(z)) for x, y, z in abin]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def pack_polygons(polygons, dtype=np.int64):
+    """returns the vertices of all `polygons` as one array, and the offsets of each polygon in this array"""
+    offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(pg) for pg in polygons])
+    vertices = np.array([point for pg in polygons for point in pg], dtype=dtype).reshape(-1, 2)
+    return vertices, offsets
+
+
+def unpack_polygons(vertices, offsets, convert=int):
+    """inverse of `pack_polygons`, coordinates are converted with `convert`"""
+    return [tuple([(convert(x), convert(y)) for x, y in vertices[start:end]]) for start, end in zip(offsets[:-1], offsets[1:])]
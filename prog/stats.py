@@ -0,0 +1,138 @@
+import json
+import threading
+import time
+from functools import wraps
+from contextlib import nullcontext
+
+# Counters and timers of the hot paths (nfp queries, minkowski sums cache, clipper operations, fitness, copies, annealing moves)
+# Collection is off by default: `count` and `timer` only check the global STATS, so instrumented code runs at almost full speed.
+# It is switched on for the current process by `enable_stats`, see the key --profile.
+# Worker processes (parallel greedy, parallel tempering, genetic algorithm) send the stats collected since their previous result
+# with each result (`collect`), and they are added to the stats of the main process (`merge`)
+STATS = None  # `Stats` of the current process, or None when collection is off
+NO_TIMER = nullcontext()  # returned by `timer` when collection is off
+
+
+class Stats:
+    """Number of occurrences and cumulated duration (for timed events only) of named events, it can be updated by several threads"""
+
+    def __init__(self):
+        self.counts = {}
+        self.times = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, name, duration):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.times[name] = self.times.get(name, 0.0) + duration
+
+    def to_dict(self, clear=False):
+        """returns {name: {'count': count, 'time': total time or None}}, and empties the stats if `clear` is True"""
+        with self.lock:
+            stats = {name: {'count': count, 'time': self.times.get(name)} for name, count in self.counts.items()}
+            if clear:
+                self.counts, self.times = {}, {}
+        return stats
+
+    def merge(self, stats):
+        """adds `stats` (see `to_dict`), e.g. collected in another process"""
+        with self.lock:
+            for name, event in stats.items():
+                self.counts[name] = self.counts.get(name, 0) + event['count']
+                if event['time'] is not None:
+                    self.times[name] = self.times.get(name, 0.0) + event['time']
+
+    def report(self):
+        """returns the lines of a table of all events, timed events first by decreasing total time"""
+        names = sorted(self.counts, key=lambda name: (-self.times.get(name, -1.0), name))
+        lines = ['{:<32} {:>10} {:>12} {:>12}'.format('event', 'count', 'total (s)', 'mean (ms)')]
+        for name in names:
+            count = self.counts[name]
+            if name in self.times:
+                lines.append('{:<32} {:>10} {:>12.4f} {:>12.4f}'.format(name, count, self.times[name], 1000 * self.times[name] / count))
+            else:
+                lines.append('{:<32} {:>10}'.format(name, count))
+        return lines
+
+
+class Timer:
+    """context manager adding its duration to the event `name` of `stats`"""
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def enable_stats():
+    """starts a new collection in the current process, returns its `Stats`"""
+    global STATS
+    STATS = Stats()
+    return STATS
+
+
+def disable_stats():
+    global STATS
+    STATS = None
+
+
+def collect():
+    """returns the stats collected in the current process since the previous call (see `Stats.to_dict`), or None when collection is off
+    Worker processes send them with their results, the main process adds them to its own stats with `merge`
+    """
+    if STATS is None:
+        return None
+    return STATS.to_dict(clear=True)
+
+
+def merge(stats):
+    """adds `stats` returned by `collect` (possibly in another process) to the stats of the current process"""
+    if STATS is not None and stats is not None:
+        STATS.merge(stats)
+
+
+def count(name, n=1):
+    if STATS is not None:
+        STATS.count(name, n)
+
+
+def timer(name):
+    """returns a context manager timing the event `name` (nothing is done when collection is off)"""
+    if STATS is None:
+        return NO_TIMER
+    return Timer(STATS, name)
+
+
+def timed(name):
+    """decorator timing every call of the function as the event `name`"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if STATS is None:
+                return function(*args, **kwargs)
+            with Timer(STATS, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_report(stats, path):
+    """prints the report of `stats`, or writes it as JSON to the file `path` if it is not '-'"""
+    if path == '-':
+        print('Profile:')
+        print('\n'.join(stats.report()))
+    else:
+        with open(path, 'w') as f:
+            json.dump(stats.to_dict(), f, indent=1)
+        print('Profile written to', path)
@@ -1,14 +1,18 @@
 import math
 import numpy as np
 
+from prog.geometry import polygon_area
+
 TRANSFORMATIONS = {}
 EPS = 0.000001
+ORIENTATIONS = [(flip, rotation) for flip in (False, True) for rotation in (0, 90, 180, 270)]  # (flip, rotation) of each orientation id
 
 
 def apply_transformations(polygon, flip=False, rotation=0):
     """apply transformations to the input polygon and returns the transformed polygon"""
     global TRANSFORMATIONS  # use as cache
-    cached_result = TRANSFORMATIONS.get((polygon, flip, rotation))
+    key = (polygon, flip, rotation)
+    cached_result = TRANSFORMATIONS.get(key)
     if cached_result is not None:
         # if cache not available, apply transformations
         return cached_result
@@ -24,9 +28,85 @@ def apply_transformations(polygon, flip=False, rotation=0):
     shift = np.min(polygon, axis=0)
     polygon = tuple([(epsilon(x - shift[0]), epsilon(y - shift[1])) for x, y in polygon]) 
     
-    TRANSFORMATIONS[(polygon, flip, rotation)] = polygon
+    TRANSFORMATIONS[key] = polygon  # saved under the input polygon, not the transformed one
     return polygon
 
+
+def vertex_cycle(polygon):
+    """key of the closed polygon `polygon` regardless of its first vertex and of its direction: the smallest of its vertex sequences
+    starting at each vertex, in both directions. Two variants with the same key are the same polygon (e.g. a square rotated by 90°)
+    """
+    vertices = [tuple(vertex) for vertex in polygon]
+    return min(min(tuple(seq[i:] + seq[:i]) for i in range(len(seq))) for seq in (vertices, vertices[::-1]))
+
+
+def orientation_index(flip, rotation):
+    """index of (flip, rotation) in ORIENTATIONS"""
+    return 4 * bool(flip) + int(rotation) // 90
+
+
+class OrientationTable:
+    """Parts of an instance with their orientations, indexed by (part id, orientation id)
+    When a part is added, its 8 orientations (ORIENTATIONS order, so orientation id 0 is the part shifted to the origin) are computed once,
+    along with the area of the part.
+    Polygons given in another way (e.g. not shifted to the origin) get the next orientation ids when they are met
+    """
+
+    def __init__(self, polygons=()):
+        self.parts = []  # part id: polygon
+        self.part_ids = {}  # polygon: part id
+        self.variants = []  # part id: list of transformed polygons (orientation id: polygon)
+        self.orient_ids = []  # part id: {transformed polygon: first orientation id with this polygon}
+        self.areas = []  # part id: area
+        self.compose = []  # part id: {orientation id: orientation ids of the variant transformed by each of ORIENTATIONS}
+        for polygon in polygons:
+            self.part_id(polygon)
+
+    def part_id(self, polygon):
+        """returns the id of `polygon`, it is added with its orientations if needed"""
+        part_id = self.part_ids.get(polygon)
+        if part_id is not None:
+            return part_id
+        part_id = len(self.parts)
+        self.part_ids[polygon] = part_id
+        self.parts.append(polygon)
+        self.variants.append([])
+        self.orient_ids.append({})
+        self.areas.append(polygon_area(polygon))
+        self.compose.append({})
+        for flip, rotation in ORIENTATIONS:
+            self.add_variant(part_id, apply_transformations(polygon, flip, rotation))
+        for orient_id in range(len(ORIENTATIONS)):
+            self.transform(part_id, orient_id, False, 0)
+        return part_id
+
+    def add_variant(self, part_id, transformed_polygon):
+        self.orient_ids[part_id].setdefault(transformed_polygon, len(self.variants[part_id]))
+        self.variants[part_id].append(transformed_polygon)
+
+    def orient_id(self, part_id, transformed_polygon):
+        """returns the orientation id of `transformed_polygon`, a variant of the part `part_id`, it is added if needed"""
+        if transformed_polygon not in self.orient_ids[part_id]:
+            self.add_variant(part_id, transformed_polygon)
+        return self.orient_ids[part_id][transformed_polygon]
+
+    def transform(self, part_id, orient_id, flip, rotation):
+        """orientation id of `apply_transformations(variant, flip, rotation)`, where variant is the orientation `orient_id` of the part `part_id`"""
+        row = self.compose[part_id].get(orient_id)
+        if row is None:
+            variant = self.variants[part_id][orient_id]
+            row = [self.orient_id(part_id, apply_transformations(variant, *orientation)) for orientation in ORIENTATIONS]
+            self.compose[part_id][orient_id] = row
+        return row[orientation_index(flip, rotation)]
+
+    def variant(self, part_id, orient_id):
+        return self.variants[part_id][orient_id]
+
+    def canonical_ids(self, part_id):
+        """list of the first orientation id (in ORIENTATIONS order) whose variant is the same polygon (cf `vertex_cycle`) as each orientation of `part_id`"""
+        firsts = {}
+        return [firsts.setdefault(vertex_cycle(self.variants[part_id][orient_id]), orient_id) for orient_id in range(len(ORIENTATIONS))]
+
 def roundup(flnum):
     if flnum == int(flnum):
         return int(flnum)
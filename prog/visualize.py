@@ -26,9 +26,9 @@ def plot_packing(packing, size=3):
     fig = plt.figure(figsize=(size * ncols, 2 * size * nrows))
     gs = fig.add_gridspec(nrows=nrows, ncols=ncols, wspace=0.1, hspace=0.1)
 
-    for i, abin in enumerate(packing.bins):
+    for i, abin in enumerate(packing.unscaled_bins()):
         ax = fig.add_subplot(gs[i // 4, i % 4], aspect='equal')
         ax.axis('off')
-        plot_bin(abin, packing.bin_size, ax)
+        plot_bin(abin, packing.unscaled_bin_size, ax)
 
     plt.show()
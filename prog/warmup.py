@@ -0,0 +1,50 @@
+import random
+import sys
+import time
+import numpy as np
+
+import prog.nfp
+from prog.nfp import set_nfp_store
+from prog.packing import Packing, clear_caches
+from prog.fitness import get_fitness_backend, set_fitness_backend
+
+# Numba functions are compiled on their first call (or when the module is imported, for functions with explicit signatures)
+# and saved in __pycache__ (cache=True), next processes load them from there.
+# `python -m prog.warmup` fills this cache once, e.g. when the program is deployed, so no run (nor worker process) compiles anything:
+# it nests a small instance with every algorithm and both fitness backends, so every function is compiled for the types it gets in a real run
+WARMUP_POLYGONS = {((0.0, 0.0), (3.0, 0.0), (3.0, 2.0), (0.0, 2.0)): 3,  # convex polygons, integer and non integer coordinates
+                   ((0.0, 0.0), (2.5, 0.0), (1.25, 2.1650635)): 3,
+                   ((0.0, 0.0), (4.0, 0.0), (4.0, 1.0), (1.0, 1.0), (1.0, 3.0), (0.0, 3.0)): 2}  # non convex, its minkowski sums are triangulated
+WARMUP_BIN_SIZE = (6.0, 6.0)
+WARMUP_ALGORITHMS = [('greedy', []), ('simulated annealing', [100.0, 10.0])]
+
+
+def warmup():
+    """Compiles the numba functions used by nestings (or loads them from the cache), returns the duration in seconds"""
+    time1 = time.perf_counter()
+    backend = get_fitness_backend()
+    nfp_store_path = prog.nfp.NFP_STORE_PATH
+    state = random.getstate(), np.random.get_state()
+    set_nfp_store(None)  # warm-up minkowski sums are not written in the persistent cache
+    try:
+        for fitness_backend in ('shapely', 'numba'):
+            set_fitness_backend(fitness_backend)
+            for algo, algo_extra in WARMUP_ALGORITHMS:
+                packing = Packing(WARMUP_BIN_SIZE, WARMUP_POLYGONS)
+                packing.nest_all(False, algo, 'descending area', algo_extra)
+    finally:
+        set_fitness_backend(backend)
+        set_nfp_store(nfp_store_path)
+        random.setstate(state[0])
+        np.random.set_state(state[1])
+        # warm-up polygons are not kept in the caches of the process
+        clear_caches()
+    return time.perf_counter() - time1
+
+
+def main():
+    print('Warm-up time:', warmup())
+
+
+if __name__ == '__main__':
+    sys.exit(main())